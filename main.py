@@ -1,207 +1,696 @@
 # import tensorrt  # Leave this here, such that pytorch import the right tensorrt
+import time
+started = time.time()  # For the startup report
 import pickle as pkl
-from multiprocessing.managers import BaseManager
-from modules.focus.gaze_estimation.focus import FocusDetector
-# from modules.focus.mutual_gaze.focus import FocusDetector
+from modules.focus.scheduler import FocusScheduler
 import os
+import importlib
 import numpy as np
-import time
+import queue
+import threading
+from collections import OrderedDict, deque
 from modules.ar.ar import ActionRecognizer
+from modules.ar.enrollment import SampleBuffer, Enrollment
 import cv2
-from playsound import playsound
-from modules.hpe.hpe import HumanPoseEstimator
+from loguru import logger
+from modules.hpe.tracker import Tracker
 from utils.params import MetrabsTRTConfig, RealSenseIntrinsics, MainConfig, FocusConfig
 from utils.params import TRXConfig
+from utils.shared_frames import SharedFrameRing
+from utils.transport import get_transport, queue_name
+from utils.metrics import metrics
+from utils.tracing import tracer
+from utils.profiling import FrameProfiler
+from utils.watchdog import Watchdog
+from utils.quality import QualityController
+from utils.clock import Clock
 from multiprocessing import Process, Queue
+imports = time.time() - started
 
 
 docker = os.environ.get('AM_I_IN_A_DOCKER_CONTAINER', False)
 
 
+class Workers:
+    """
+    HPE and focus workers with their queues and the shared frames, that can serve several ISBFSAR (streams).
+    Each worker is a process or, if configured in args.execution, a thread of this process that receives the frames
+    by reference. HPE can have a pool of args.hpe_workers workers that take the frames round-robin.
+    Every result is tagged with the submission number of its frame and waited until a deadline (see Watchdog), a
+    worker process that stalls or dies is restarted. A thread can not be killed, so it is not replaced (that would
+    load its engines again): a stalled one is reported, a dead one stops main.py. Results are asked in order of
+    submission to the worker that got the frame, so the ones of a pool are delivered in frame order even if they
+    arrive out of order
+    """
+    def __init__(self, args, n_streams=1):
+        self.args = args
+        self.depth = args.pipeline_depth * n_streams
+        self.execution = args.execution
+        self.pools = {"focus": 1, "hpe": args.hpe_workers}
+        if self.depth < args.hpe_workers:  # The workers of the pool beyond the frames in flight would never get one
+            raise ValueError(f"hpe_workers ({args.hpe_workers}) can not be more than the frames in flight "
+                             f"(pipeline_depth * streams = {self.depth})")
+
+        # Frames are written once in shared memory and the worker processes receive just their reference
+        # (one slot for each frame in the input queues, one for each worker and one being written)
+        self.frames = None
+        processes = sum(n for stage, n in self.pools.items() if not self.threaded(stage))
+        if args.shared_frames and processes > 0:
+            self.frames = SharedFrameRing(processes * (self.depth + 1) + 1, (args.cam_height, args.cam_width, 3))
+
+        # Load modules (queues can hold one frame for each pipeline stage in flight). They are imported only by the
+        # workers (TensorRT, mediapipe, ...), which load them in parallel
+        self.hpe_config = MetrabsTRTConfig()
+        if self.hpe_config.detect_every > 1 and (n_streams > 1 or args.hpe_workers > 1):
+            # The tracks of a worker follow the frames it gets, they must be the consecutive frames of one camera
+            logger.warning("HPE tracking (detect_every > 1) disabled: frames of several cameras or HPE workers")
+            self.hpe_config.detect_every = 1
+        # from modules.focus.mutual_gaze.focus import FocusDetector
+        self.modules = {"focus": ("modules.focus.gaze_estimation.focus.FocusDetector", (FocusConfig(),)),
+                        "hpe": ("modules.hpe.hpe.HumanPoseEstimator", (self.hpe_config, RealSenseIntrinsics()))}
+        self.tensorrt = {"focus": False, "hpe": True}  # Modules that run TensorRT engines (they need a pycuda context)
+        self.deadlines = {"focus": args.focus_deadline, "hpe": args.hpe_deadline}
+        self.workers = [(stage, i) for stage, n in self.pools.items() for i in range(n)]
+        release = None if self.frames is None else self.frames.release  # Main releases the frames of the workers
+        self.watchdogs = {worker: Watchdog(worker[0], args.max_misses, release) for worker in self.workers}
+        self.inputs, self.outputs, self.procs, self.names = {}, {}, {}, {}
+        self.settings = {stage: {} for stage in self.modules.keys()}  # Attributes of the module set at runtime
+        self.limits = {}  # (stage, attribute): value asked by each stream, the workers get the smallest one
+        for worker in self.workers:
+            self.start(worker)
+        self.tag = 0
+        self.turn = {stage: 0 for stage in self.modules.keys()}  # Next worker of the pool, round-robin
+        self.assigned = {stage: {} for stage in self.modules.keys()}  # Tag: worker of the pool that got the frame
+        self.restarts = {stage: 0 for stage in self.modules.keys()}
+        self.stalled = set()  # Worker threads reported as stalled, until they give a result in time
+
+    def threaded(self, stage):
+        return self.execution.get(stage, "process") == "thread"
+
+    def start(self, worker):
+        stage, i = worker
+        module, configurations = self.modules[stage]
+        name = module.split(".")[-1] + ("" if i == 0 else f"_{i}")  # For metrics, traces and profiles
+        self.names[worker] = name
+        if self.threaded(stage):
+            self.inputs[worker] = queue.Queue(self.depth)
+            self.outputs[worker] = queue.Queue(self.depth)
+            self.procs[worker] = threading.Thread(target=run_module, args=(module, configurations,
+                                                                           self.inputs[worker], self.outputs[worker]),
+                                                  kwargs={"thread": True, "name": name,
+                                                          "tensorrt": self.tensorrt[stage]}, daemon=True)
+        else:
+            self.inputs[worker] = Queue(self.depth)
+            self.outputs[worker] = Queue(self.depth)
+            self.procs[worker] = Process(target=run_module, args=(module, configurations,
+                                                                  self.inputs[worker], self.outputs[worker],
+                                                                  self.frames, self.args),
+                                         kwargs={"name": name, "tensorrt": self.tensorrt[stage]})
+        self.procs[worker].start()
+        self.watchdogs[worker].attach(self.outputs[worker])
+        if len(self.settings[stage]) > 0:  # A restarted worker keeps the settings changed at runtime
+            self.inputs[worker].put(("set", None, dict(self.settings[stage])))
+
+    def wait_ready(self):
+        """
+        Wait until every worker loaded its module, it returns the seconds each one took
+        """
+        times = {}
+        for worker in self.workers:
+            while True:
+                try:
+                    _, times[self.names[worker]] = self.outputs[worker].get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not self.procs[worker].is_alive():
+                        raise RuntimeError(f"{self.names[worker]} died while loading")
+            self.watchdogs[worker].loading = False
+        return times
+
+    def restart(self, worker):
+        """
+        Kill a stalled worker process and start a new one, the references of the frames it got are released here
+        """
+        self.procs[worker].terminate()
+        self.procs[worker].join()
+        self.watchdogs[worker].drain(self.outputs[worker])
+        self.restarts[worker[0]] += 1
+        self.start(worker)
+
+    def next_tag(self):
+        self.tag += 1
+        return self.tag
+
+    def stop(self, worker):
+        """
+        Stop a worker thread, the frames still in its input are dropped
+        """
+        while True:
+            try:
+                self.inputs[worker].get(block=False)
+            except queue.Empty:
+                break
+        self.inputs[worker].put(("stop", None, None))
+
+    def share(self, img, stages):
+        """
+        Write the frame in shared memory for the given stages that run in a process, it returns its reference
+        (None if no stage needs it)
+        """
+        readers = [stage for stage in stages if not self.threaded(stage)]
+        if self.frames is None or len(readers) == 0:
+            return None
+        return self.frames.write(img, n_readers=len(readers), timeout=self.args.frame_write_timeout)
+
+    def by_value(self, stage, ref=None):
+        """
+        Whether the workers of the stage receive the image itself instead of its reference in shared memory
+        """
+        return ref is None or self.threaded(stage)
+
+    def submit(self, stage, tag, frame, img, ref=None):
+        """
+        Give a frame to the next worker of the stage whose input is not full: threads receive the image itself,
+        processes its reference in shared memory if it was shared. If all the inputs are full, the frame waits for
+        the next worker until the deadline, then it is skipped
+        """
+        shared = not self.by_value(stage, ref)
+        item = (tag, frame, ref if shared else img)
+        n = self.pools[stage]
+        first = self.turn[stage]
+        self.turn[stage] = (first + 1) % n
+        for i in [(first + k) % n for k in range(n)]:
+            try:
+                self.inputs[(stage, i)].put(item, block=False)
+                break
+            except queue.Full:
+                continue
+        else:
+            i = first
+            try:
+                self.inputs[(stage, i)].put(item, timeout=self.deadlines[stage])
+            except queue.Full:
+                self.assigned[stage][tag] = i
+                self.watchdogs[(stage, i)].skipped.add(tag)
+                if shared:
+                    self.frames.release(ref)
+                return
+        self.assigned[stage][tag] = i
+        self.watchdogs[(stage, i)].submitted(tag, ref if shared else None)
+
+    def result(self, stage, tag, submission):
+        """
+        It returns (True, result) or (False, None) if the worker missed the deadline of the frame
+        """
+        worker = (stage, self.assigned[stage].pop(tag))
+        deadline = None if self.deadlines[stage] is None else submission + self.deadlines[stage]
+        ok, result = self.watchdogs[worker].get(tag, deadline)
+        if self.threaded(stage):
+            self.check_thread(worker)
+        elif self.watchdogs[worker].stalled or not self.procs[worker].is_alive():
+            self.restart(worker)
+        return ok, result
+
+    def check_thread(self, worker):
+        """
+        A worker thread that died raises, a stalled one is reported once and its frames go on being served stale
+        """
+        if not self.procs[worker].is_alive():
+            raise RuntimeError(f"Worker thread {self.names[worker]} died")
+        if not self.watchdogs[worker].stalled:
+            self.stalled.discard(worker)
+        elif worker not in self.stalled:
+            self.stalled.add(worker)
+            logger.error(f"Worker thread {self.names[worker]} stalled, it can not be restarted")
+
+    def control(self, stage, command, args):
+        """
+        Send a command to all the workers of the stage
+        """
+        if command == "set":
+            self.settings[stage].update(args)
+        for i in range(self.pools[stage]):
+            self.inputs[(stage, i)].put((command, None, args))
+
+    def limit(self, stage, key, value, stream=None):
+        """
+        Set an attribute of the module of the stage that the streams share (e.g. max_people): each stream asks for
+        its own value, the workers get the smallest one
+        """
+        values = self.limits.setdefault((stage, key), {})
+        values[stream] = value
+        value = min(values.values())
+        if self.settings[stage].get(key) != value:
+            self.control(stage, "set", {key: value})
+
+    def close(self):
+        for worker in self.workers:
+            if self.threaded(worker[0]):
+                self.stop(worker)
+        if self.frames is not None:
+            self.frames.close()
+
+
 class ISBFSAR:
-    def __init__(self, args, visualizer=True, video_input=None):
+    def __init__(self, args, visualizer=True, video_input=None, output=None, clock=None, workers=None, model=None,
+                 stream=None, command_input=None, command_output=None):
+        """
+        video_input and output replace the queues towards the host (e.g. for replay.py), without visualizer no
+        output is sent. The clock is the one of the frame timestamps, a virtual one when replaying.
+        command_input and command_output replace the command channel: then commands are executed between two frames
+        (deterministic replay) instead of by their own thread.
+        workers and model (TRXOS) are given when they are shared with other streams (see server.py), stream is the
+        name of the camera
+        """
         self.input_type = args.input_type
-
-        # Load modules
-        self.focus_in = Queue(1)
-        self.focus_out = Queue(1)
-        self.focus_proc = Process(target=run_module, args=(FocusDetector,
-                                                           (FocusConfig(),),
-                                                           self.focus_in, self.focus_out))
-        self.focus_proc.start()
-
-        self.hpe_in = Queue(1)
-        self.hpe_out = Queue(1)
-        self.hpe_proc = Process(target=run_module, args=(HumanPoseEstimator,
-                                                         (MetrabsTRTConfig(), RealSenseIntrinsics()),
-                                                         self.hpe_in, self.hpe_out))
-        self.hpe_proc.start()
-
-        self.ar = ActionRecognizer(TRXConfig(), add_hook=False)
-
-        # Create communication with host
-        BaseManager.register('get_queue')
-        manager = BaseManager(address=("host.docker.internal" if docker else "localhost", 50000), authkey=b'abracadabra')
-        manager.connect()
-        self._in_queue = manager.get_queue('source_human')  # To get rgb or msg
-        self._out_queue = manager.get_queue('human_sink')  # To send element to VISPY
+        self.pipeline_depth = args.pipeline_depth
+        self.stream = stream
+        metrics.configure("main", args)
+
+        self.owns_workers = workers is None
+        self.workers = Workers(args) if workers is None else workers
+        self.frames = self.workers.frames
+
+        loading = time.time()
+        self.ar = ActionRecognizer(TRXConfig(), add_hook=False, model=model)
+        self.startup = {"imports": imports, "ActionRecognizer": time.time() - loading}
+        self.multi_person = self.workers.hpe_config.multi_person
+        self.tracker = Tracker(args)
+        self.focus_scheduler = FocusScheduler(args)
+        self.quality = QualityController(args, self.multi_person, self.workers.hpe_config.max_people)
+        self.ar_frames = 0
+        self.last_is_true = 0
+        self.last_focus = None  # (focus, face_bbox, submission time) of the last frame focus ran on
+        self.last_humans = ([], {}, {})  # (ids, tracks, main human) of the last frame HPE gave in time
+        self.last_results = {}  # Action recognition of the last frame HPE gave in time
+
+        # Create communication with host (frames got from the source stay in use until they leave the pipeline)
+        self._in_queue = video_input  # To get rgb
+        self._out_queue = output  # To send element to VISPY
+        self._command_in = command_input  # To get commands
+        self._command_out = command_output  # To answer commands
+        if video_input is None:
+            transport = get_transport(args, stream=stream)
+            self._in_queue = transport.get_queue(queue_name('source_human', stream), manual=True)
+            if visualizer and output is None:
+                self._out_queue = transport.get_queue(queue_name('human_sink', stream))
+            if command_input is None:
+                self._command_in = transport.get_queue(queue_name('source_command', stream))
+                self._command_out = transport.get_queue(queue_name('command_source', stream))
 
         # Variables
         self.cam_width = args.cam_width
         self.cam_height = args.cam_height
         self.window_size = args.window_size
-        self.fps_s = []
+        self.fps_s = deque(maxlen=10)
         self.last_poses = []
         self.skeleton_scale = args.skeleton_scale
         self.acquisition_time = args.acquisition_time
+        self.enrollment_delay = args.enrollment_delay
+        self.samples = SampleBuffer(self.acquisition_time + 1)  # Poses and crops of the last frames, for enrollment
+        self.enrollment = None
         self.edges = None
-
-    def get_frame(self, img=None, log=None):
+        self.clock = Clock() if clock is None else clock
+        self.in_flight = deque()  # (img, submission time, capture time, focus ran, id, tag, message) in flight
+        self.last_emission = None
+        self.idle = 0.  # Seconds spent waiting for a frame since the last result
+        self.max_frame_age = args.max_frame_age
+        self.dropped = 0  # Frames dropped by the source or because too old
+        self.processed = 0
+        self.staleness = deque(maxlen=100)  # Seconds between capture and ingestion of the last processed frames
+        self.preview_every = args.preview_every
+        self.preview_scale = args.preview_scale
+        self.preview_quality = args.preview_quality
+        self.emitted = 0
+        self.saved_path = os.path.join('assets', 'saved') if stream is None else os.path.join('assets', 'saved', stream)
+        self.profiler = FrameProfiler("main" if stream is None else f"main_{stream}")
+
+        # The modules load in parallel, the first frame waits for all of them
+        if self.owns_workers:
+            logger.info(startup_report(self.startup, self.workers.wait_ready()))
+
+        # Commands are served by their own thread (or between frames, when the command channel is given)
+        self.lock = threading.Lock()  # Samples and enrollment, shared by frames and commands
+        self.closing = threading.Event()
+        self.command_thread = None
+        if self._command_in is not None and command_input is None:
+            self.command_thread = threading.Thread(target=self.serve_commands, daemon=True)
+            self.command_thread.start()
+
+    def get_frame(self, img=None, log=None, ts=None, frame=None, data=None):
         """
-        get frame, do inference, return all possible info
+        get frame, do inference, return all possible info. data is the message of the source img comes from, if any
+        With pipeline_depth > 1 the new frame is only submitted to HPE and focus, and the returned elements belong to
+        the oldest frame in flight, so that action recognition of frame N overlaps with HPE and focus of frame N+1.
+        While the pipeline is filling up, None is returned
         """
-        start = time.time()
-        elements = {}
-        ar_input = {}
-
         # If img is not given (not a video), try to get img
         if img is None:
-            img = self._in_queue.get()["rgb"]
-        elements["img"] = img
+            data = self.ingest()
+            img, ts, frame = data["rgb"], data.get("ts"), data.get("id")
 
-        # Start independent modules
-        self.focus_in.put(img)
-        self.hpe_in.put(img)
+        self.submit(img, ts, frame, data)
+        if len(self.in_flight) < self.pipeline_depth:
+            return None
+        return self.collect(log=log)
 
-        # RGB CASE
-        hpe_res = self.hpe_out.get()
-        if self.input_type == "hybrid" or self.input_type == "rgb":
-            if hpe_res is not None:
-                x1, x2, y1, y2 = hpe_res['bbox']
-                elements["bbox"] = x1, x2, y1, y2
-                xm = int((x1 + x2) / 2)
-                ym = int((y1 + y2) / 2)
-                l = max(xm - x1, ym - y1)
-                img_ = img[(ym - l if ym - l > 0 else 0):(ym + l), (xm - l if xm - l > 0 else 0):(xm + l)]
-                img_ = cv2.resize(img_, (224, 224))
-                # cv2.imshow("", img_)  # TODO REMOVE DEBUG
-                # cv2.waitKey(1)  # TODO REMOVE DEBUG
-                img_ = img_ / 255.
-                img_ = img_ * np.array([0.229, 0.224, 0.225]) + np.array([0.485, 0.456, 0.406])
-                img_ = img_.swapaxes(-1, -3).swapaxes(-1, -2)
-                ar_input["rgb"] = img_
-                elements["img_preprocessed"] = img_
+    def ingest(self, block=True):
+        """
+        Get the newest frame from the source, dropping the older ones and the ones captured more than
+        max_frame_age seconds ago, such that the reaction time stays bounded when the inference is slow.
+        The returned message has to be given to submit or to release_input.
+        If not block, queue.Empty is raised when there is no frame
+        """
+        while True:
+            wait = time.time()
+            data = self._in_queue.get(block=block)
+            self.idle += time.time() - wait
+            while True:  # Newest frame wins
+                self.dropped += data.get("dropped", 0)
+                try:
+                    newer = self._in_queue.get(block=False)
+                except queue.Empty:
+                    break
+                self.dropped += 1
+                self.release_input(data)
+                data = newer
+            staleness = self.clock.time() - data["ts"] if "ts" in data.keys() else 0.
+            if self.max_frame_age is not None and staleness > self.max_frame_age:
+                self.dropped += 1
+                self.release_input(data)
+                continue
+            self.processed += 1
+            self.staleness.append(staleness)
+            metrics.record("main.capture_to_ingest", staleness)
+            if "ts" in data.keys():
+                tracer.record("main.capture_to_ingest", data["ts"], data["ts"] + staleness, data.get("id"))
+            return data
+
+    def release_input(self, data):
+        """
+        Give the message of the source back to the transport (with shm the source can then overwrite its frame)
+        """
+        if data is not None and hasattr(self._in_queue, "release"):
+            self._in_queue.release(data)
 
-        # SKELETON CASE
-        if self.input_type == "hybrid" or self.input_type == "skeleton":
-            if hpe_res is not None:
-                pose, edges, bbox = hpe_res['pose'], hpe_res['edges'], hpe_res['bbox']
-                if self.edges is None:
-                    self.edges = edges
-                if pose is not None:
-                    elements["distance"] = np.sqrt(np.sum(np.square(np.array([0, 0, 0]) - np.array(pose[0])))) * 2.5
-                    pose = pose - pose[0, :]
-                    elements["pose"] = pose
-                    ar_input["sk"] = pose.reshape(-1)
-                elements["edges"] = edges
-                if bbox is not None:
-                    elements["bbox"] = bbox
+    def submit(self, img, ts=None, frame=None, data=None):
+        """
+        Start independent modules on a new frame without waiting for their results.
+        The workers receive the id of the frame (given by the source) with the frame, for tracing.
+        data, the message of the source img comes from, is released when the frame leaves the pipeline
+        """
+        ts = self.clock.time() if ts is None else ts
+        frame = self.processed if frame is None else frame
+        focus = self.focus_scheduler.should_run(self.ar.requires_focus, self.last_is_true)
+        tag = self.workers.next_tag()
+        start = time.time()
+        stages = ["focus", "hpe"] if focus else ["hpe"]
+        ref = self.workers.share(img, stages)
+        if data is not None and any(self.workers.by_value(stage, ref) for stage in stages):
+            # A late worker may still read the image when it went back to the source (e.g. shm transport)
+            img = img.copy()
+        if focus:
+            self.workers.submit("focus", tag, frame, img, ref)
+        self.workers.submit("hpe", tag, frame, img, ref)
+        self.in_flight.append((img, start, ts, focus, frame, tag, data))
+
+    def collect(self, log=None):
+        """
+        Wait for the results of the oldest frame in flight, do action recognition and send the elements to the sink
+        """
+        frame = self.receive(log)
+        if not self.ar_due(frame["inputs"]):
+            return self.emit(frame, None)
+        return self.emit(frame, self.ar.inference_batch(frame["inputs"]))
+
+    def ar_due(self, inputs):
+        """
+        Whether action recognition has to score this frame (see ar_stride), otherwise the inputs just go in the windows
+        """
+        self.ar_frames += 1
+        if self.ar_frames % self.quality.knobs["ar_stride"] == 0:
+            return True
+        self.ar.add_frames(inputs)
+        return False
+
+    def receive(self, log=None):
+        """
+        Wait for the HPE results of the oldest frame in flight and prepare the input of action recognition for
+        each human (track)
+        """
+        img, start, ts, focus_ran, frame, tag, data = self.in_flight.popleft()
+        tracer.frame = frame
+        self.profiler.begin()
+        elements = {}
+        sample = {}
+        elements["img"] = img
+        elements["ts"] = ts
+        elements["id"] = frame
+
+        sw = metrics.stopwatch()
+        hpe_ok, hpe_res = self.workers.result("hpe", tag, start)
+        sw.lap("main.hpe_wait")
+
+        inputs, tracks = {}, {}
+        if not hpe_ok:  # HPE missed the deadline: the last humans are shown again and action recognition waits
+            ids, tracks, info = self.last_humans
+            elements.update(info)
+            elements["hpe_stale"] = True
+        elif not self.multi_person:
+            ids = [0]
+            inputs[0], sample, info = self.prepare_human(img, hpe_res)
+            elements.update(info)
+            self.last_humans = (ids, tracks, info)
+        else:
+            # Every human keeps its own window, the main one (the most confident) is also shown as in single mode
+            humans = hpe_res if hpe_res is not None else []
+            ids = self.tracker.update(humans)
+            for track in self.tracker.lost:
+                self.ar.forget_track(track)
+            for track, human in zip(ids, humans):
+                inputs[track], human_sample, tracks[track] = self.prepare_human(img, human)
+                if track == ids[0]:
+                    sample = human_sample
+                    elements.update(tracks[track])
+                tracks[track].pop("img_preprocessed", None)
+            self.last_humans = (ids, tracks, tracks[ids[0]] if len(ids) > 0 else {})
+        sw.lap("main.ar_preprocess")
+
+        return {"elements": elements, "inputs": inputs, "ids": ids, "tracks": tracks, "sample": sample,
+                "start": start, "ts": ts, "focus_ran": focus_ran, "log": log, "sw": sw, "tag": tag,
+                "hpe_stale": not hpe_ok, "data": data}
+
+    def emit(self, frame, results):
+        """
+        Complete the elements of a received frame with the results of action recognition (track: results, None if
+        it was skipped) and focus, and send them to the sink. Then the frame leaves the pipeline: the image of the
+        returned elements may be overwritten by the source
+        """
+        elements, ids, tracks, sample = frame["elements"], frame["ids"], frame["tracks"], frame["sample"]
+        start, ts, focus_ran, log, sw = frame["start"], frame["ts"], frame["focus_ran"], frame["log"], frame["sw"]
+        sw.lap("main.ar")
+        if frame["hpe_stale"] or results is None:  # Only the humans still in the frame
+            results = {track: r for track, r in self.last_results.items() if track in ids}
+        else:
+            self.last_results = results
 
-        # Make inference
-        results = self.ar.inference(ar_input)
-        actions, is_true, requires_focus = results
+        # The main human is the first one
+        actions, is_true, requires_focus = results.get(ids[0], ({}, 0, {})) if len(ids) > 0 else ({}, 0, {})
         elements["actions"] = actions
         elements["is_true"] = is_true
         elements["requires_focus"] = requires_focus
-
-        # FOCUS #######################################################
-        focus_ret = self.focus_out.get()
-        if focus_ret is not None:
-            focus, face = focus_ret
-            elements["focus"] = focus
-            elements["face_bbox"] = face.bbox.reshape(-1)
+        self.last_is_true = max([float(np.max(r[1])) for r in results.values()], default=0.)
+        if self.multi_person:
+            for track, (track_actions, track_is_true, _) in results.items():
+                tracks[track].update({"actions": track_actions, "is_true": track_is_true})
+            elements["tracks"] = tracks
+
+        # FOCUS (if it did not run on this frame, reuse the last result) ##########################
+        if focus_ran:
+            focus_ok, focus_ret = self.workers.result("focus", frame["tag"], start)
+            sw.lap("main.focus_wait")
+            if focus_ok:
+                self.last_focus = None
+                if focus_ret is not None:
+                    focus, face = focus_ret
+                    self.last_focus = focus, face.bbox.reshape(-1), start
+            else:  # Focus missed the deadline
+                elements["focus_stale"] = True
+        if self.last_focus is not None:
+            elements["focus"], elements["face_bbox"], focus_start = self.last_focus
+            elements["focus_age"] = start - focus_start
 
         end = time.time()
-
-        # Compute fps
+        elements["latency"] = end - start
+        metrics.record("main.frame_latency", end - start)
+
+        # Adapt the quality to the time the pipeline is busy on each frame
+        change = None
+        if self.last_emission is not None:
+            change = self.quality.update(end - self.last_emission - self.idle)
+            if change is not None:
+                self.apply_quality()
+                logger.info(change)
+        self.idle = 0.
+
+        # Compute fps (when pipelined, frames overlap and the throughput is given by the time between two results)
+        if self.pipeline_depth > 1 and self.last_emission is not None:
+            start = self.last_emission
+        self.last_emission = end
         self.fps_s.append(1. / (end - start))
-        fps_s = self.fps_s[-10:]
-        fps = sum(fps_s) / len(fps_s)
+        fps = sum(self.fps_s) / len(self.fps_s)
         elements["fps"] = fps
+        elements["ingestion"] = {"dropped": self.dropped,
+                                 "processed": self.processed,
+                                 "staleness": sum(self.staleness) / len(self.staleness) if self.staleness else 0.}
+
+        # Keep the sample for enrollment, if it is complete w.r.t. input type
+        with self.lock:
+            if len(sample) == (2 if self.input_type == "hybrid" else 1):
+                self.samples.append(ts, sample)
+            if self.enrollment is not None and log is None:
+                if self.enrollment.is_ready(self.samples):
+                    log = self.finish_enrollment()
+                else:
+                    log = self.enrollment.progress(ts)
+
+        report = self.profiler.end()
+        if report is not None and log is None:
+            log = "Profile written in " + report
+        if change is not None and log is None:
+            log = change
 
         # Msg
         if log is not None:
             elements["log"] = log
 
-        self._out_queue.put(elements)
+        if self._out_queue is not None:
+            self._out_queue.put(self.message(elements))
+        sw.lap("main.output")
+        self.release_input(frame["data"])
+        metrics.maybe_export()
 
         return elements
 
+    def apply_quality(self):
+        knobs = self.quality.knobs
+        metrics.gauge(("main" if self.stream is None else f"main_{self.stream}") + ".quality_level", self.quality.level)
+        self.focus_scheduler.every = knobs["focus_every"]
+        if self.multi_person:
+            self.workers.limit("hpe", "max_people", knobs["max_people"], self.stream)
+
+    def message(self, elements):
+        """
+        What is sent to the sink: the elements without the images, with a downscaled (and JPEG encoded) preview of
+        the frame every preview_every frames
+        """
+        msg = {k: v for k, v in elements.items() if k not in ["img", "img_preprocessed"]}
+        self.emitted += 1
+        if self.preview_every is not None and self.emitted % self.preview_every == 0:
+            img = elements["img"]
+            msg["img_shape"] = img.shape
+            if self.preview_scale != 1:
+                img = cv2.resize(img, None, fx=self.preview_scale, fy=self.preview_scale, interpolation=cv2.INTER_AREA)
+            if self.preview_quality is not None:
+                img = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.preview_quality])[1]
+            msg["preview"] = img
+        return msg
+
+    def flush(self):
+        """
+        Emit all the frames still in flight
+        """
+        results = []
+        while len(self.in_flight) > 0:
+            results.append(self.collect())
+        return results
+
     def run(self):
         while True:
-            log = None
-            data = self._in_queue.get()
+            data = self.ingest()
+            if self.command_thread is None:
+                self.poll_commands()
+            if self.closing.is_set():
+                self.release_input(data)
+                break
+            self.get_frame(img=data["rgb"], ts=data.get("ts"), frame=data.get("id"), data=data)
+
+        self.flush()
+        if self.owns_workers:
+            self.workers.close()
+
+    def serve_commands(self):
+        """
+        Answer the commands as soon as they arrive, while the frames go on
+        """
+        while not self.closing.is_set():
+            self.handle(self._command_in.get())
+
+    def poll_commands(self):
+        while self._command_in is not None:
+            try:
+                request = self._command_in.get(block=False)
+            except queue.Empty:
+                return
+            self.handle(request)
+
+    def handle(self, request):
+        log = self.command(request["command"])
+        if self._command_out is not None:
+            self._command_out.put({"id": request.get("id"), "command": request["command"], "log": log})
+
+    def command(self, msg):
+        """
+        Execute a command and return the log to show
+        """
+        log = None
+        if msg is None or msg.strip() == '':
+            return log
 
-            if "msg" in data.keys() and data["msg"] != '':
+        msg = msg.strip()
+        msg = msg.split()
 
-                msg = data["msg"]
-                msg = msg.strip()
-                msg = msg.split()
+        # select appropriate command
+        if msg[0] == 'close' or msg[0] == 'exit' or msg[0] == 'quit' or msg[0] == 'q':
+            self.closing.set()
 
-                # select appropriate command
-                if msg[0] == 'close' or msg[0] == 'exit' or msg[0] == 'quit' or msg[0] == 'q':
-                    break
+        elif msg[0] == "add" and len(msg) > 1:
+            log = self.learn_command(msg[1:])
 
-                elif msg[0] == "add" and len(msg) > 1:
-                    self._out_queue.put({"ACK": True})  # This must be sent as answer to not stop the program
-                    log = self.learn_command(msg[1:])
-                    data = self._in_queue.get()
+        elif msg[0] == "remove" and len(msg) > 1:
+            log = self.forget_command(msg[1])
 
-                elif msg[0] == "remove" and len(msg) > 1:
-                    log = self.forget_command(msg[1])
+        elif msg[0] == "save":
+            log = self.save()
 
-                # elif msg[0] == "test" and len(msg) > 1:
-                #     self.test_video(msg[1])
+        elif msg[0] == "load":
+            log = self.load()
 
-                elif msg[0] == "save":
-                    log = self.save()
+        elif msg[0] == "debug":
+            self.debug()
 
-                elif msg[0] == "load":
-                    log = self.load()
+        elif msg[0] == "profile" and len(msg) > 1 and msg[1].isdigit():
+            log = self.profile_command(int(msg[1]), msg[2:])
+        else:
+            log = "Not a valid command!"
+        return log
 
-                elif msg[0] == "debug":
-                    self.debug()
-                else:
-                    log = "Not a valid command!"
-            self.get_frame(img=data["rgb"], log=log)
-
-    # def test_video(self, path):
-    #     if not os.path.exists(path):
-    #         self.log("Video file does not exists!")
-    #         return
-    #
-    #     video = cv2.VideoCapture(path)
-    #     video_length = video.get(cv2.CAP_PROP_FRAME_COUNT)
-    #     i = 0
-    #     fps = video.get(cv2.CAP_PROP_FPS)
-    #     ret, img = video.read()
-    #     while ret:
-    #         start = time.time()
-    #         key = cv2.waitKey(1)
-    #         if key > -1:
-    #             break
-    #         self.log("{:.2f}%".format((i / (video_length - 1)) * 100))
-    #         _ = self.get_frame(img)
-    #
-    #         n_skip = int((time.time() - start) * fps)
-    #         for _ in range(n_skip):
-    #             _, _ = video.read()
-    #             i += 1
-    #
-    #         ret, img = video.read()
-    #         i += 1
-    #     self.log("100%")
-    #     video.release()
+    def profile_command(self, n, stages):
+        """
+        Profile the next n frames of the given stages (main, hpe, focus, all of them by default) while they run:
+        the workers get the request in their input queue, before the next frame
+        """
+        stages = stages if len(stages) > 0 else ["main", "hpe", "focus"]
+        if any(s not in ["main", "hpe", "focus"] for s in stages):
+            return "Stages can be main, hpe and focus"
+        path = os.path.join('assets', 'profiles', time.strftime("%Y%m%d-%H%M%S"))
+        if "main" in stages:
+            self.profiler.request(n, path)
+        if "hpe" in stages:
+            self.workers.control("hpe", "profile", (n, path))
+        if "focus" in stages:
+            self.workers.control("focus", "profile", (n, path))
+        return f"Profiling {n} frames of {', '.join(stages)} in {path}"
 
     def forget_command(self, flag):
         if self.ar.remove(flag):
@@ -210,7 +699,8 @@ class ISBFSAR:
             return "Action {} is not in the support set".format(flag)
 
     def debug(self):
-        ss = self.ar.support_set
+        with self.ar.lock:
+            ss = OrderedDict(self.ar.support_set)
         if len(ss) == 0:
             return
         if self.input_type in ["hybrid", "imgs"]:
@@ -240,106 +730,176 @@ class ISBFSAR:
             cv2.imshow("support_set_SK", visual)
         cv2.waitKey(0)
 
+    def prepare_human(self, img, hpe_res):
+        """
+        Input of action recognition, sample for enrollment and elements to show for one human
+        """
+        ar_input = {}
+        sample = {}
+        info = {}
+
+        # RGB CASE
+        if self.input_type == "hybrid" or self.input_type == "rgb":
+            if hpe_res is not None:
+                x1, x2, y1, y2 = hpe_res['bbox']
+                info["bbox"] = x1, x2, y1, y2
+                xm = int((x1 + x2) / 2)
+                ym = int((y1 + y2) / 2)
+                l = max(xm - x1, ym - y1)
+                img_ = img[(ym - l if ym - l > 0 else 0):(ym + l), (xm - l if xm - l > 0 else 0):(xm + l)]
+                img_ = cv2.resize(img_, (224, 224))
+                # cv2.imshow("", img_)  # TODO REMOVE DEBUG
+                # cv2.waitKey(1)  # TODO REMOVE DEBUG
+                sample["imgs"] = img_
+                img_ = normalize_crop(img_)
+                ar_input["rgb"] = img_
+                info["img_preprocessed"] = img_
+
+        # SKELETON CASE
+        if self.input_type == "hybrid" or self.input_type == "skeleton":
+            if hpe_res is not None:
+                pose, edges, bbox = hpe_res['pose'], hpe_res['edges'], hpe_res['bbox']
+                if self.edges is None:
+                    self.edges = edges
+                if pose is not None:
+                    info["distance"] = np.sqrt(np.sum(np.square(np.array([0, 0, 0]) - np.array(pose[0])))) * 2.5
+                    pose = pose - pose[0, :]
+                    info["pose"] = pose
+                    ar_input["sk"] = pose.reshape(-1)
+                    sample["poses"] = ar_input["sk"]
+                info["edges"] = edges
+                if bbox is not None:
+                    info["bbox"] = bbox
+        return ar_input, sample, info
+
     def learn_command(self, flag):
+        """
+        Start the acquisition of a new action without stopping the main loop: the samples of the next
+        acquisition_time seconds (after the delay) are taken from the buffer when available.
+        With -last, the action is learned right away from the last acquisition_time seconds
+        """
         requires_focus = "-focus" in flag
+        last = "-last" in flag
         flag = flag[0]
-        now = time.time()
-        while (time.time() - now) < 3:
-            self.get_frame(log="WAIT...")
-
-        self.get_frame(log="GO!")
-        # playsound('assets' + os.sep + 'start.wav')
-        data = [[] for _ in range(self.window_size)]
-        i = 0
-        off_time = (self.acquisition_time / self.window_size)
-        while i < self.window_size:
-            start = time.time()
-            res = self.get_frame(log="{:.2f}%".format((i / (self.window_size - 1)) * 100))
-            # Check if the sample is good w.r.t. input type
-            good = self.input_type in ["skeleton", "hybrid"] and "pose" in res.keys() and res["pose"] is not None
-            good = good or self.input_type == "rgb"
-            if good:
-                if self.input_type in ["skeleton", "hybrid"]:
-                    data[i].append(res["pose"].reshape(-1))  # CAREFUL with the reshape
-                if self.input_type in ["rgb", "hybrid"]:
-                    data[i].append(res["img_preprocessed"])
-                i += 1
-            while (time.time() - start) < off_time:  # Busy wait
-                continue
-
-        # playsound('assets' + os.sep + 'stop.wav')
-        # self.log("100%")
-
-        # If a path to a video is provided
-        # else:
-        #     if not os.path.exists(flag[0]):
-        #         self.log("Video file does not exist!")
-        #         return
-        #     # self.cap.release()
-        #     video = cv2.VideoCapture(flag[0])
-        #     poses = []
-        #     fps = video.get(cv2.CAP_PROP_FPS)
-        #     video_length = video.get(cv2.CAP_PROP_FRAME_COUNT)
-        #     ret, img = video.read()
-        #     i = 0
-        #     while ret:
-        #         start = time.time()
-        #         img = cv2.resize(img, (self.cam_width, self.cam_height))
-        #         cv2.waitKey(1)
-        #         _, pose, _ = self.get_frame(img)
-        #
-        #         if pose is not None:
-        #             poses.append(pose)
-        #
-        #         n_skip = int((time.time() - start) * fps)
-        #         for _ in range(n_skip):
-        #             _, _ = video.read()
-        #             i += 1
-        #
-        #         ret, img = video.read()
-        #         self.log("{:.2f}%".format((i / (video_length - 1)) * 100))
-        #         i += 1
-        #     self.log("100%")
-        #     video.release()
-        #     flag = flag[0].split('/')[-1].split('.')[0]  # between / and .
-        #     data = np.stack(poses)
-        #     data = data[:(len(data) - (len(data) % self.window_size))]
-        #     data = data[list(range(0, len(data), int(len(data) / self.window_size)))]
-        inp = {"flag": flag,
+        with self.lock:
+            if last:
+                if self.samples.last_ts() is None:
+                    return "No samples to learn action " + flag
+                self.enrollment = Enrollment(flag, requires_focus, self.samples.last_ts(), self.enrollment_delay,
+                                             self.acquisition_time, last=True)
+                return self.finish_enrollment()
+            self.enrollment = Enrollment(flag, requires_focus, self.clock.time(), self.enrollment_delay,
+                                         self.acquisition_time)
+            return self.enrollment.progress(self.clock.time())
+
+    def finish_enrollment(self):
+        enrollment = self.enrollment
+        self.enrollment = None
+        data = self.samples.window(enrollment.start, enrollment.end, self.window_size)
+        if data is None:
+            return "No samples to learn action " + enrollment.flag
+
+        inp = {"flag": enrollment.flag,
                "data": {},
-               "requires_focus": requires_focus}
-
-        if self.input_type == "rgb":  # Unique case with images in first position
-            inp["data"]["imgs"] = np.stack([x[0] for x in data])
+               "requires_focus": enrollment.requires_focus}
         if self.input_type in ["skeleton", "hybrid"]:
-            inp["data"]["poses"] = np.stack([x[0] for x in data])
-        if self.input_type == "hybrid":
-            inp["data"]["imgs"] = np.stack([x[1] for x in data])
+            inp["data"]["poses"] = np.stack([x["poses"] for x in data])
+        if self.input_type in ["rgb", "hybrid"]:
+            inp["data"]["imgs"] = np.stack([normalize_crop(x["imgs"]) for x in data])
         self.ar.train(inp)
-        return "Action " + flag + " learned successfully!"
+        return "Action " + enrollment.flag + " learned successfully!"
 
     def save(self):
-        with open('assets/saved/support_set.pkl', 'wb') as outfile:
-            pkl.dump(self.ar.support_set, outfile)
-        with open('assets/saved/requires_focus.pkl', 'wb') as outfile:
-            pkl.dump(self.ar.requires_focus, outfile)
-        return "Classes saved successfully in " + 'assets/saved/support_set.pkl'
+        os.makedirs(self.saved_path, exist_ok=True)
+        with self.ar.lock:
+            support_set, requires_focus = OrderedDict(self.ar.support_set), self.ar.requires_focus
+        with open(os.path.join(self.saved_path, 'support_set.pkl'), 'wb') as outfile:
+            pkl.dump(support_set, outfile)
+        with open(os.path.join(self.saved_path, 'requires_focus.pkl'), 'wb') as outfile:
+            pkl.dump(requires_focus, outfile)
+        return "Classes saved successfully in " + os.path.join(self.saved_path, 'support_set.pkl')
 
     def load(self):
-        with open('assets/saved/support_set.pkl', 'rb') as pkl_file:
-            self.ar.support_set = pkl.load(pkl_file)
-        with open('assets/saved/requires_focus.pkl', 'rb') as pkl_file:
-            self.ar.requires_focus = pkl.load(pkl_file)
-        return f"Loaded {len(self.ar.support_set)} classes"
-
-
-def run_module(module, configurations, input_queue, output_queue):
-    import pycuda.autoinit
+        with open(os.path.join(self.saved_path, 'support_set.pkl'), 'rb') as pkl_file:
+            support_set = pkl.load(pkl_file)
+        with open(os.path.join(self.saved_path, 'requires_focus.pkl'), 'rb') as pkl_file:
+            requires_focus = pkl.load(pkl_file)
+        self.ar.load(support_set, requires_focus)
+        return f"Loaded {len(support_set)} classes"
+
+
+def normalize_crop(img):
+    """
+    From the 224x224 BGR crop of the human to the input of the rgb branch
+    """
+    img = img / 255.
+    img = img * np.array([0.229, 0.224, 0.225]) + np.array([0.485, 0.456, 0.406])
+    return img.swapaxes(-1, -3).swapaxes(-1, -2)
+
+
+def startup_report(*times):
+    """
+    Seconds spent loading each module (they load in parallel), with the total since main.py was imported
+    """
+    times = {name: seconds for t in times for name, seconds in t.items()}
+    for name, seconds in times.items():
+        metrics.record(f"startup.{name}", seconds)
+    return f"Ready in {time.time() - started:.1f} s (" + ", ".join(f"{k} {v:.1f} s" for k, v in times.items()) + ")"
+
+
+def run_module(module, configurations, input_queue, output_queue, frames=None, args=None, thread=False, name=None,
+               tensorrt=True):
+    """
+    Loop of a worker, module is the import path of its class. It sends ("ready", seconds) when the module is loaded.
+    If tensorrt, the module runs TensorRT engines and a CUDA context is made current for pycuda.
+    If thread, it runs in a thread of main.py: it shares the metrics and the tracer of the process and the primary
+    CUDA context of the GPU (the one of pytorch) instead of creating its own
+    """
+    loading = time.time()
+    context = None
+    if tensorrt and thread:
+        import pycuda.driver as cuda
+        cuda.init()
+        context = cuda.Device(0).retain_primary_context()
+        context.push()
+    elif tensorrt:
+        import pycuda.autoinit
+    path, module = module.rsplit(".", 1)
+    module = getattr(importlib.import_module(path), module)
+    name = module.__name__ if name is None else name
+    if args is not None:
+        metrics.configure(name, args)
     x = module(*configurations)
+    output_queue.put(("ready", time.time() - loading))
+    profiler = FrameProfiler(name)
     while True:
-        inp = input_queue.get()
-        y = x.estimate(inp)
-        output_queue.put(y)
+        sw = metrics.stopwatch()
+        tag, frame, inp = input_queue.get()
+        if tag == "stop":
+            break
+        if tag == "profile":  # Control messages have no output
+            profiler.request(*inp)
+            continue
+        if tag == "set":
+            for k, v in inp.items():
+                setattr(x, k, v)
+            continue
+        sw.frame = frame
+        if not thread:  # The tracer of main.py is working on its own frame
+            tracer.frame = frame
+        sw.lap(f"{name}.queue_wait")
+        profiler.begin()
+        if frames is None:
+            y = x.estimate(inp)
+        else:  # inp is the reference to a frame in shared memory, main.py releases it when it gets the result
+            y = x.estimate(frames.read(inp))
+        profiler.end()
+        sw.lap(f"{name}.estimate")
+        output_queue.put((tag, y))
+        sw.lap(f"{name}.output_wait")
+        metrics.maybe_export()
+    if context is not None:
+        context.pop()
 
 
 if __name__ == "__main__":
@@ -1,28 +1,40 @@
-from collections import OrderedDict
+import threading
+from collections import OrderedDict, deque
+from contextlib import ExitStack
 import numpy as np
 from modules.ar.utils.model import TRXOS
 from utils.params import TRXConfig
 import torch
 from tqdm import tqdm
-import copy
+from utils.metrics import metrics
+from utils import weight_store
 
 
 class ActionRecognizer:
-    def __init__(self, args, add_hook=False):
+    def __init__(self, args, add_hook=False, model=None):
         self.input_type = args.input_type
         self.device = args.device
 
-        self.ar = TRXOS(TRXConfig(), add_hook=add_hook)
-        # Fix dataparallel
-        state_dict = torch.load(args.final_ckpt_path, map_location=torch.device(0))['model_state_dict']
-        state_dict = OrderedDict({param.replace('.module', ''): data for param, data in state_dict.items()})
-        self.ar.load_state_dict(state_dict)
-        self.ar.cuda()
-        self.ar.eval()
-
+        if model is not None:  # Shared with other recognizers, that have their own support set and windows
+            self.ar = model
+        else:
+            self.ar = TRXOS(TRXConfig(), add_hook=add_hook, pretrained=False)  # The checkpoint has all the weights
+            # Fix dataparallel
+            if args.load_cache:  # Raw copy of the checkpoint, faster to load than unpickling it
+                state_dict = weight_store.load(args.final_ckpt_path, 'model_state_dict')
+            else:
+                state_dict = torch.load(args.final_ckpt_path, map_location=torch.device(0))['model_state_dict']
+            state_dict = OrderedDict({param.replace('.module', ''): data for param, data in state_dict.items()})
+            self.ar.load_state_dict(state_dict)
+            self.ar.cuda()
+            self.ar.eval()
+
+        # Commands change the support set from another thread: they hold the lock, as inference does.
+        # requires_focus is replaced instead of modified, so that it can be read without the lock
+        self.lock = threading.Lock()
         self.support_set = OrderedDict()
         self.requires_focus = {}
-        self.previous_frames = []
+        self.previous_frames = {}  # Track id: window of its last seq_len frames
         self.seq_len = args.seq_len
         self.way = args.way
         self.n_joints = args.n_joints if args.input_type == "skeleton" else 0
@@ -31,69 +43,155 @@ class ActionRecognizer:
         """
         It receives an iterable of data that contains poses, images or both
         """
-        if data is None or len(data) == 0:
-            return {}, 0, {}
-
-        if len(self.support_set) == 0:  # no class to predict
-            return {}, 0, {}
-
-        # Process new frame
-        data = {k: torch.FloatTensor(v).cuda() for k, v in data.items()}
-        self.previous_frames.append(copy.deepcopy(data))
-        if len(self.previous_frames) < self.seq_len:  # few samples
-            return {}, 0, {}
-        elif len(self.previous_frames) == self.seq_len + 1:
-            self.previous_frames = self.previous_frames[1:]  # add as last frame
-
-        # Prepare query with previous frames
-        for t in list(data.keys()):
-            data[t] = torch.stack([elem[t] for elem in self.previous_frames]).unsqueeze(0)
-        labels = torch.IntTensor(list(range(len(self.support_set)))).unsqueeze(0).cuda()
-
-        # Get SS
+        return self.inference_batch({0: data}).get(0, ({}, 0, {}))
+
+    def inference_batch(self, tracks):
+        """
+        It receives a dictionary with the data of each track (poses, images or both) and returns, for each track
+        with new data and a full window, the results of its window. All the windows are scored in a single forward
+        """
+        return inference_streams({None: (self, tracks)})[None]
+
+    def add_frames(self, tracks):
+        """
+        Append the new data of each track to its window, it returns the tracks that can be scored
+        """
+        ready = []
+        for track, data in tracks.items():
+            if data is None or len(data) == 0:
+                continue
+            if track not in self.previous_frames.keys():
+                self.previous_frames[track] = deque(maxlen=self.seq_len)
+            self.previous_frames[track].append({k: torch.FloatTensor(v).cuda() for k, v in data.items()})
+            if len(self.previous_frames[track]) == self.seq_len:
+                ready.append(track)
+        return ready
+
+    def queries(self, ready):
+        data = {}
+        for t in self.previous_frames[ready[0]][0].keys():
+            data[t] = torch.stack([torch.stack([elem[t] for elem in self.previous_frames[track]])
+                                   for track in ready])
+        return data
+
+    def has_features(self):
+        return all('features' in self.support_set[c].keys() for c in self.support_set.keys())
+
+    def support(self, b):
+        """
+        Support set (or its features, if already computed) with the batch dimension of b queries
+        """
         ss = None
         ss_f = None
-        if all('features' in self.support_set[c].keys() for c in self.support_set.keys()):
+        if self.has_features():
             ss_f = torch.stack([self.support_set[c]["features"] for c in self.support_set.keys()])  # 3 16 90
             pad = torch.zeros_like(ss_f[0]).unsqueeze(0)
             while ss_f.shape[0] < self.way:
                 ss_f = torch.concat((ss_f, pad), dim=0)
-            ss_f = ss_f.unsqueeze(0)  # Add batch dimension
+            ss_f = ss_f.unsqueeze(0).expand(b, *ss_f.shape)
         else:
             ss = {}
             if self.input_type in ["rgb", "hybrid"]:
                 ss["rgb"] = torch.stack([self.support_set[c]["imgs"] for c in self.support_set.keys()]).unsqueeze(0)
             if self.input_type in ["skeleton", "hybrid"]:
                 ss["sk"] = torch.stack([self.support_set[c]["poses"] for c in self.support_set.keys()]).unsqueeze(0)
-        with torch.no_grad():
-            outputs = self.ar(ss, labels, data, ss_features=ss_f)  # RGB, POSES
+            ss = {k: v.expand(b, *v.shape[1:]) for k, v in ss.items()}
+        return ss, ss_f
 
+    def results(self, ready, outputs, few_shot_result, open_set_result, offset):
+        """
+        Results of the tracks in ready, whose queries start at offset in the batch
+        """
         # Save support features
-        if ss_f is None:
+        if not self.has_features():
             for i, s in enumerate(self.support_set.keys()):
-                self.support_set[s]['features'] = outputs['support_features'][0][i]  # zero to remove batch dimension
-
-        # Softmax
-        few_shot_result = torch.softmax(outputs['logits'].squeeze(0), dim=0).detach().cpu().numpy()
-        open_set_result = outputs['is_true'].squeeze(0).detach().cpu().numpy()
+                self.support_set[s]['features'] = outputs['support_features'][offset][i]
 
-        # Return output
         results = {}
-        for k in range(len(self.support_set)):
-            results[list(self.support_set.keys())[k]] = (few_shot_result[k])
-        return results, open_set_result, self.requires_focus
+        for i, track in enumerate(ready):
+            actions = {}
+            for k in range(len(self.support_set)):
+                actions[list(self.support_set.keys())[k]] = (few_shot_result[offset + i][k])
+            results[track] = (actions, open_set_result[offset + i], self.requires_focus)
+        return results
+
+    def forget_track(self, track):
+        self.previous_frames.pop(track, None)
 
     def remove(self, flag):
-        if flag in self.support_set.keys():
-            self.support_set.pop(flag)
-            self.requires_focus.pop(flag)
-            return True
-        else:
-            return False
+        with self.lock:
+            if flag in self.support_set.keys():
+                self.support_set.pop(flag)
+                self.requires_focus = {k: v for k, v in self.requires_focus.items() if k != flag}
+                return True
+            else:
+                return False
 
     def train(self, inp):
-        self.support_set[inp['flag']] = {c: torch.FloatTensor(inp['data'][c]).cuda() for c in inp['data'].keys()}
-        self.requires_focus[inp['flag']] = inp['requires_focus']
+        support = {c: torch.FloatTensor(inp['data'][c]).cuda() for c in inp['data'].keys()}
+        with self.lock:
+            self.support_set[inp['flag']] = support
+            self.requires_focus = {**self.requires_focus, inp['flag']: inp['requires_focus']}
+
+    def load(self, support_set, requires_focus):
+        with self.lock:
+            self.support_set = support_set
+            self.requires_focus = requires_focus
+
+
+def inference_streams(jobs):
+    """
+    Score the tracks of several recognizers that share the same model, in as few forwards as possible.
+    jobs is a dictionary key: (recognizer, data of each track), it returns key: results of each track.
+    Recognizers with the same number of classes are batched together (the discriminator takes the best class among
+    all the logits, so padding classes would change the open-set score)
+    """
+    with ExitStack() as stack:
+        for recognizer in {id(r): r for r, _ in jobs.values()}.values():
+            stack.enter_context(recognizer.lock)
+        return _inference_streams(jobs)
+
+
+def _inference_streams(jobs):
+    results = {key: {} for key in jobs.keys()}
+    groups = {}
+    for key, (recognizer, tracks) in jobs.items():
+        if len(recognizer.support_set) == 0:  # no class to predict
+            continue
+        ready = recognizer.add_frames(tracks)
+        if len(ready) == 0:  # few samples
+            continue
+        group = (len(recognizer.support_set), recognizer.has_features())
+        groups.setdefault(group, []).append((key, recognizer, ready))
+
+    for (n_classes, _), group in groups.items():
+        sw = metrics.stopwatch()
+        queries, supports, supports_f = [], [], []
+        for key, recognizer, ready in group:
+            queries.append(recognizer.queries(ready))
+            ss, ss_f = recognizer.support(len(ready))
+            supports.append(ss)
+            supports_f.append(ss_f)
+        data = {t: torch.cat([q[t] for q in queries]) for t in queries[0].keys()}
+        ss = {t: torch.cat([s[t] for s in supports]) for t in supports[0].keys()} if supports[0] is not None else None
+        ss_f = torch.cat(supports_f) if supports_f[0] is not None else None
+        labels = torch.IntTensor(list(range(n_classes))).unsqueeze(0).cuda()
+        sw.lap("ar.prepare")
+        with torch.no_grad():
+            outputs = group[0][1].ar(ss, labels, data, ss_features=ss_f)  # RGB, POSES
+        sw.lap("ar.model")
+
+        # Softmax
+        few_shot_result = torch.softmax(outputs['logits'], dim=1).detach().cpu().numpy()
+        open_set_result = outputs['is_true'].detach().cpu().numpy()
+
+        # Return output
+        offset = 0
+        for key, recognizer, ready in group:
+            results[key] = recognizer.results(ready, outputs, few_shot_result, open_set_result, offset)
+            offset += len(ready)
+        sw.lap("ar.postprocess")
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+from collections import deque
+import numpy as np
+
+
+class SampleBuffer:
+    """
+    Timestamped ring buffer of the samples (pose and/or crop) that the main loop already computed for each frame
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()  # (ts, sample) in increasing ts
+
+    def append(self, ts, sample):
+        self.samples.append((ts, sample))
+        while self.samples and self.samples[0][0] < ts - self.seconds:
+            self.samples.popleft()
+
+    def last_ts(self):
+        return self.samples[-1][0] if self.samples else None
+
+    def window(self, start, end, size):
+        """
+        Resample [start, end] to size samples, taking for each instant the closest sample in time
+        """
+        samples = [(ts, s) for ts, s in self.samples if start <= ts <= end]
+        if len(samples) == 0:
+            return None
+        times = np.array([ts for ts, _ in samples])
+        targets = np.linspace(start, end, size)
+        idx = np.abs(times[None, :] - targets[:, None]).argmin(axis=1)
+        return [samples[i][1] for i in idx]
+
+
+class Enrollment:
+    """
+    Acquisition of a new action from the buffer: the window starts after the delay (to let the user get ready),
+    or it is the last acquisition_time seconds if last is True
+    """
+    def __init__(self, flag, requires_focus, now, delay, acquisition_time, last=False):
+        self.flag = flag
+        self.requires_focus = requires_focus
+        self.start = now - acquisition_time if last else now + delay
+        self.end = self.start + acquisition_time
+
+    def progress(self, now):
+        if now < self.start:
+            return "WAIT..."
+        return "{:.2f}%".format(min((now - self.start) / (self.end - self.start), 1.) * 100)
+
+    def is_ready(self, buffer):
+        return buffer.last_ts() is not None and buffer.last_ts() >= self.end
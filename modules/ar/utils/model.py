@@ -258,7 +258,10 @@ class TRXOS(nn.Module):
 
             return x
 
-    def __init__(self, args, add_hook=False):
+    def __init__(self, args, add_hook=False, pretrained=True):
+        """
+        pretrained downloads the ImageNet weights of the ResNet, useless when a checkpoint is loaded right after
+        """
         super(TRXOS, self).__init__()
         self.args = args
         self.way = args.way
@@ -269,10 +272,10 @@ class TRXOS(nn.Module):
             self.features_extractor['sk'] = MLP(args.n_joints * 3, args.n_joints * 3 * 2, 256)
         if args.input_type in ["rgb", "hybrid"]:
             if add_hook:
-                resnet = self.myresnet50(pretrained=True)
+                resnet = self.myresnet50(pretrained=pretrained)
                 self.features_extractor["rgb"] = nn.Sequential(*list(resnet.children())[:-1])
             else:
-                resnet = resnet50(pretrained=True)  # weights='ResNet50_Weights.DEFAULT'
+                resnet = resnet50(pretrained=pretrained)  # weights='ResNet50_Weights.DEFAULT'
                 self.features_extractor["rgb"] = nn.Sequential(*list(resnet.children())[:-1])  # TODO NEW
                 # self.features_extractor["rgb"] = resnet  # TODO OLD
 
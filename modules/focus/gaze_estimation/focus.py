@@ -4,6 +4,7 @@ from tqdm import tqdm
 from scipy.spatial.transform import Rotation
 import yaml
 import numpy as np
+from utils.metrics import metrics
 
 
 class FocusDetector:
@@ -103,13 +104,16 @@ class FocusDetector:
         return frame
 
     def estimate(self, frame):
+        sw = metrics.stopwatch()
         faces = self.gaze_estimator.detect_faces(frame)
+        sw.lap("focus.face_detection")
 
         if len(faces) == 0:
             return None
 
         fc = faces[0]  # We can only have one face
         self.gaze_estimator.estimate_gaze(frame, fc)
+        sw.lap("focus.gaze_estimation")
 
         face = fc
         focus = None
@@ -136,6 +140,7 @@ class FocusDetector:
             self.focuses.append(focus)
             self.focuses = self.focuses[-self.patience:]
             self.is_focus = self.focuses.count(True) > len(self.focuses) / 2
+        sw.lap("focus.postprocess")
 
         return focus, fc
 
@@ -1,5 +1,5 @@
 from modules.focus.mutual_gaze.head_detection.utils.misc import get_model
-from modules.hpe.utils.misc import nms_cpu
+from modules.hpe.utils.detection import nms
 import torch.optim
 import copy
 from torchvision import transforms
@@ -37,15 +37,10 @@ class FocusDetector:
         res = self.head_model([inp])
         boxes = res[0]['boxes'].detach().int().cpu().numpy()
         scores = res[0]['scores'].detach().cpu().numpy()
-        good = nms_cpu(boxes, scores, nms_thresh=0.01)
-
         # Filter candidates
-        if len(good) > 0:
-            boxes = boxes[good]
-            scores = scores[good]
-            good = scores > 0.8
-            boxes = boxes[good]
-            scores = scores[good]
+        good = nms(boxes, scores, nms_thresh=0.01, score_thresh=0.8)
+        boxes = boxes[good]
+        scores = scores[good]
 
         # Take best candidate and postprocess image
         if len(boxes) > 0:
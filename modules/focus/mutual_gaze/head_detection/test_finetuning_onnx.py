@@ -1,6 +1,6 @@
 import cv2
 import torch
-from modules.hpe.utils.misc import nms_cpu
+from modules.hpe.utils.detection import nms
 from onnxruntime import InferenceSession
 from tqdm import tqdm
 import numpy as np
@@ -16,17 +16,9 @@ if __name__ == "__main__":
         res = model.run(None, {'img': inp[None, ...]})
         boxes = res[0].astype(int)
         scores = res[2]
-        good = nms_cpu(boxes, scores, nms_thresh=0.01)
-
-        if len(good) > 0:
-            boxes = boxes[good]
-            scores = scores[good]
-            good = scores > 0.8
-            boxes = boxes[good]
-            scores = scores[good]
-            if len(boxes) > 0:
-                for box in boxes:
-                    img = cv2.rectangle(img, (box[0], box[1]), (box[2], box[3]), (0, 255, 0), 2)
+        good = nms(boxes, scores, nms_thresh=0.01, score_thresh=0.8)
+        for box in boxes[good]:
+            img = cv2.rectangle(img, (box[0], box[1]), (box[2], box[3]), (0, 255, 0), 2)
 
         cv2.imshow("", img)
         cv2.waitKey(1)
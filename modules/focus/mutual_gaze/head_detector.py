@@ -1,7 +1,7 @@
 import cv2
 import torch
 from modules.focus.mutual_gaze.head_detection.utils.misc import get_model
-from modules.hpe.utils.misc import nms_cpu
+from modules.hpe.utils.detection import nms
 from tqdm import tqdm
 
 
@@ -19,14 +19,9 @@ class HeadDetector:
         res = self.model([inp])
         boxes = res[0]['boxes'].detach().int().cpu().numpy()
         scores = res[0]['scores'].detach().cpu().numpy()
-        good = nms_cpu(boxes, scores, nms_thresh=0.01)
-
-        if len(good) > 0:
-            boxes = boxes[good]
-            scores = scores[good]
-            good = scores > 0.8
-            boxes = boxes[good]
-            scores = scores[good]
+        good = nms(boxes, scores, nms_thresh=0.01, score_thresh=0.8)
+        boxes = boxes[good]
+        scores = scores[good]
 
         return boxes, scores
 
@@ -0,0 +1,23 @@
+class FocusScheduler:
+    """
+    Decide, before submitting a frame, if the focus detector has to run on it.
+    Focus is useless if no action in the support set requires it, and it matters only when the open-set score is
+    close enough to the threshold to trigger an action. When it does not run, the last result is reused with its age
+    """
+    def __init__(self, args):
+        self.every = args.focus_every  # Run at most once every this many frames
+        self.os_thresh = args.os_thresh
+        self.os_margin = args.focus_os_margin  # None runs focus whatever the open-set score is
+        self.skipped = self.every  # Frames since the last run
+
+    def should_run(self, requires_focus, is_true):
+        """
+        requires_focus and is_true are the last output of the ActionRecognizer
+        """
+        run = any(requires_focus.values())
+        if run and self.os_margin is not None:
+            run = is_true >= self.os_thresh - self.os_margin
+        if run and self.skipped + 1 < self.every:
+            run = False
+        self.skipped = 0 if run else self.skipped + 1
+        return run
@@ -1,14 +1,14 @@
-import copy
 import pickle
-from modules.hpe.utils.misc import postprocess_yolo_output, homography, get_augmentations, is_within_fov, \
-    reconstruct_absolute
-import einops
+from modules.hpe.utils.misc import preprocess_yolo, homography, get_augmentations, is_within_fov, \
+    reconstruct_absolute, to_homogeneous
+from modules.hpe.utils.detection import postprocess_detections
+from modules.hpe.utils.heatmap_decoder import HeatmapDecoder
 import numpy as np
 from utils.tensorrt_runner import Runner
 from utils.params import MetrabsTRTConfig, RealSenseIntrinsics, MainConfig
 from tqdm import tqdm
 import cv2
-from utils.matplotlib_visualizer import MPLPosePrinter
+from utils.metrics import metrics
 
 
 class HumanPoseEstimator:
@@ -19,10 +19,22 @@ class HumanPoseEstimator:
         else:
             self.just_box = just_box
 
+        self.multi_person = model_config.multi_person
+        self.max_people = model_config.max_people
         self.yolo_thresh = model_config.yolo_thresh
         self.nms_thresh = model_config.nms_thresh
         self.num_aug = model_config.num_aug
         self.n_test = 1 if self.num_aug < 1 else self.num_aug
+        self.batch_size = model_config.batch_size  # Crops in each call of the engines without augmentation
+
+        # Between two detections, the boxes follow the poses (not in rgb mode, that has no pose)
+        self.detect_every = model_config.detect_every
+        self.track_min_fov = model_config.track_min_fov
+        self.track_max_drop = model_config.track_max_drop
+        self.track_margin = model_config.track_margin
+        self.tracking = self.detect_every > 1 and not self.just_box and self.num_aug == 0
+        self.tracks = None  # (box, velocity, fov at detection) of each human of the last frame, boxes as yolo ones
+        self.since_detection = 0
 
         # Intrinsics and K matrix of RealSense
         self.K = np.zeros((3, 3), np.float32)
@@ -38,6 +50,8 @@ class HumanPoseEstimator:
         with open(model_config.skeleton_types_path, "rb") as input_file:
             self.skeleton_types = pickle.load(input_file)
 
+        self.decoder = HeatmapDecoder()
+
         # Load modules
         self.yolo = Runner(model_config.yolo_engine_path)  # model_config.yolo_engine_path
         if not self.just_box:
@@ -46,41 +60,164 @@ class HumanPoseEstimator:
             self.heads = Runner(model_config.heads_engine_path)
 
     def estimate(self, frame):
-
-        # Preprocess for yolo
-        square_img = cv2.resize(frame, (256, 256), fx=1.0, fy=1.0, interpolation=cv2.INTER_AREA)
-        yolo_in = copy.deepcopy(square_img)
-        yolo_in = cv2.cvtColor(yolo_in, cv2.COLOR_BGR2RGB)
-        yolo_in = np.transpose(yolo_in, (2, 0, 1)).astype(np.float32)
-        yolo_in = np.expand_dims(yolo_in, axis=0)
-        yolo_in = yolo_in / 255.0
+        """
+        Pose of the most confident human (None if there is none) or, in multi-person mode, the list of the poses of
+        the max_people most confident humans
+        """
+        sw = metrics.stopwatch()
+        humans = self.predict()
+        if humans is None:
+            humans = self.detect(frame, sw)
+            humans = humans[:self.max_people] if self.multi_person else humans[:1]
+            self.since_detection = 0
+        else:
+            self.since_detection += 1
+            sw.lap("hpe.track")
+        if self.num_aug > 0:  # The batch of the engines holds the augmentations of a single human
+            results = [self.estimate_human(frame, human, sw) for human in humans]
+        else:
+            results = self.estimate_batch(frame, humans, sw)
+        if self.tracking:
+            self.track(frame, results)
+        if not self.multi_person:
+            return results[0] if len(results) > 0 else None
+        return [res for res in results if res is not None]
+
+    def detect(self, frame, sw):
+        """
+        Boxes of the humans in the frame (x1, y1, x2, y2, confidence, class), with decreasing probability
+        """
+        # Preprocess for yolo, directly in the input of the engine
+        preprocess_yolo(frame, self.yolo.input_buffer())
+        sw.lap("hpe.yolo_preprocess")
 
         # Yolo
-        outputs = self.yolo(yolo_in)
-        boxes, confidences = outputs[0].reshape(1, 4032, 1, 4), outputs[1].reshape(1, 4032, 80)
-        bboxes_batch = postprocess_yolo_output(boxes, confidences, self.yolo_thresh, self.nms_thresh)
-
-        # Get only the bounding box with the human with highest probability
-        box = bboxes_batch[0]  # Remove batch dimension
-        humans = []
-        for e in box:  # For each object in the image
-            if e[5] == 0:  # If it is a human
-                humans.append(e)
-        if len(humans) > 0:
-            humans.sort(key=lambda x: x[4], reverse=True)  # Sort with decreasing probability
-            human = humans[0]
-        else:
+        outputs = self.yolo()
+        sw.lap("hpe.yolo")
+        boxes, confidences = outputs[0].reshape(1, 4032, 4), outputs[1].reshape(1, 4032, 80)
+        humans = postprocess_detections(boxes, confidences, self.yolo_thresh, self.nms_thresh)[0]
+        sw.lap("hpe.yolo_postprocess")
+        return humans
+
+    def predict(self):
+        """
+        Boxes of the tracked humans in this frame, None if yolo has to run
+        """
+        if self.tracks is None or self.since_detection + 1 >= self.detect_every:
             return None
-
-        # Preprocess for BackBone
+        return [np.clip(box + velocity, 0., 1.) for box, velocity, _ in self.tracks]
+
+    def track(self, frame, results):
+        """
+        Boxes of the humans from the 2D extent of their poses, and their motion since the last frame.
+        Tracking stops, so yolo runs on the next frame, when a pose is lost, has too few joints inside its crop or its
+        confidence (the fraction of joints inside the crop) dropped by track_max_drop since the detection
+        """
+        if len(results) == 0 or any(res is None for res in results):
+            self.tracks = None
+            return
+        detected = [res["fov"] for res in results] if self.since_detection == 0 else [t[2] for t in self.tracks]
+        if any(res["fov"] < max(self.track_min_fov, fov - self.track_max_drop) for res, fov in zip(results, detected)):
+            self.tracks = None
+            return
+        h, w = frame.shape[:2]
+        tracks = []
+        for i, res in enumerate(results):
+            (x1, y1), (x2, y2) = res["joints2d"].min(axis=0), res["joints2d"].max(axis=0)
+            mx, my = (x2 - x1) * self.track_margin, (y2 - y1) * self.track_margin
+            box = np.array([(x1 - mx) / w, (y1 - my) / h, (x2 + mx) / w, (y2 + my) / h])
+            velocity = box - self.tracks[i][0] if self.since_detection > 0 else np.zeros(4)
+            tracks.append((box, velocity, detected[i]))
+        self.tracks = tracks
+
+    @staticmethod
+    def box(frame, human):
+        """
+        Pixel coordinates (x1, x2, y1, y2) of the normalized box of a human
+        """
         x1 = int(human[0] * frame.shape[1]) if int(human[0] * frame.shape[1]) > 0 else 0
         y1 = int(human[1] * frame.shape[0]) if int(human[1] * frame.shape[0]) > 0 else 0
         x2 = int(human[2] * frame.shape[1]) if int(human[2] * frame.shape[1]) > 0 else 0
         y2 = int(human[3] * frame.shape[0]) if int(human[3] * frame.shape[0]) > 0 else 0
+        return x1, x2, y1, y2
+
+    def estimate_batch(self, frame, humans, sw):
+        """
+        Poses of the given humans (None for the ones mostly out of their crop), without test time augmentation.
+        The crops go through image_transformation, bbone and heads batch_size at a time
+        """
+        boxes = [self.box(frame, human) for human in humans]
+
+        # If we are doing rgb inference, we need just the box
+        if self.just_box:
+            return [{"bbox": box} for box in boxes]
+
+        results = []
+        for i in range(0, len(boxes), self.batch_size):
+            results += self.estimate_crops(frame, boxes[i:i + self.batch_size], sw)
+        return results
+
+    def estimate_crops(self, frame, boxes, sw):
+        n = len(boxes)
+        new_K, homo_inv = zip(*[homography(x1, x2, y1, y2, self.K, 256) for x1, x2, y1, y2 in boxes])
+        new_K, homo_inv = np.stack(new_K), np.concatenate(homo_inv)  # n 3 3
+
+        # Apply homography (the engines have a fixed batch, the last crop fills it)
+        H = self.K @ np.linalg.inv(new_K @ homo_inv)
+        H_batch = np.concatenate([H, np.tile(H[-1:], (self.batch_size - n, 1, 1))])
+        bbone_in = self.image_transformation(frame.astype(int), H_batch.astype(np.float32))
+        sw.lap("hpe.image_transformation")
+
+        bbone_in = bbone_in[0].reshape(self.batch_size, 256, 256, 3)
+        bbone_in_ = (bbone_in / 255.0).astype(np.float32)
+
+        # BackBone
+        outputs = self.bbone(bbone_in_)
+        sw.lap("hpe.bbone")
+
+        # Heads
+        logits = self.heads(outputs[0])
+        sw.lap("hpe.heads")
+
+        logits = logits[0].reshape(self.batch_size, 8, 8, 288)[:n]
+        pred2d, pred3d = self.decoder(logits)
+        sw.lap("hpe.decode")
+
+        # If less than 1/4 of the joints is visible, then the resulting pose will be weird
+        is_predicted_to_be_in_fov = is_within_fov(pred2d)
+        fov = is_predicted_to_be_in_fov.mean(axis=1)
+        valid = fov >= 1 / 4
+
+        # 2D joints in the frame (H maps the pixels of the crop to the ones of the frame)
+        joints2d = to_homogeneous(pred2d) @ H.swapaxes(1, 2)
+        joints2d = joints2d[..., :2] / joints2d[..., 2:]
+
+        # Move the skeletons into estimated absolute position and go back in original space
+        pred3d = reconstruct_absolute(pred2d, pred3d, new_K, is_predicted_to_be_in_fov, weak_perspective=False)
+        pred3d = pred3d @ homo_inv
+
+        # Get correct skeleton
+        pred3d = (pred3d.swapaxes(1, 2) @ self.expand_joints).swapaxes(1, 2)
+        if self.skeleton is not None:
+            pred3d = pred3d[:, self.skeleton_types[self.skeleton]['indices']]
+            edges = self.skeleton_types[self.skeleton]['edges']
+        else:
+            edges = None
+        sw.lap("hpe.postprocess")
+
+        return [{"pose": pose, "edges": edges, "bbox": box, "joints2d": j2d, "fov": float(f)} if ok else None
+                for pose, box, j2d, f, ok in zip(pred3d, boxes, joints2d, fov, valid)]
+
+    def estimate_human(self, frame, human, sw):
+        """
+        Pose of a human with test time augmentation, the batch of the engines holds its num_aug crops
+        """
+        # Preprocess for BackBone
+        x1, x2, y1, y2 = self.box(frame, human)
 
         # If we are doing rgb inference, we need just the box
         if self.just_box:
-            return {"bbox": (x1, y1, x2, y2)}
+            return {"bbox": (x1, x2, y1, y2)}
 
         new_K, homo_inv = homography(x1, x2, y1, y2, self.K, 256)
 
@@ -95,61 +232,30 @@ class HumanPoseEstimator:
         # Apply homography
         H = self.K @ np.linalg.inv(new_K @ homo_inv)
         bbone_in = self.image_transformation(frame.astype(int), H.astype(np.float32))
+        sw.lap("hpe.image_transformation")
 
         bbone_in = bbone_in[0].reshape(self.n_test, 256, 256, 3)  # [..., ::-1]
         bbone_in_ = (bbone_in / 255.0).astype(np.float32)
 
         # BackBone
         outputs = self.bbone(bbone_in_)
+        sw.lap("hpe.bbone")
 
         # Heads
         logits = self.heads(outputs[0])
+        sw.lap("hpe.heads")
 
-        # Get logits 3d  TODO DO THE SAME WITH 2D
+        # Get 2D and 3D poses
         logits = logits[0].reshape(1, 8, 8, 288)
-        _, logits2d, logits3d = np.split(logits, [0, 32], axis=3)
-        current_format = 'b h w (d j)'
-        logits3d = einops.rearrange(logits3d, f'{current_format} -> b h w d j', j=32)  # 5, 8, 8, 9, 32
-
-        # 3D Softmax
-        heatmap_axes = (2, 1, 3)
-        max_along_axis = logits3d.max(axis=heatmap_axes, keepdims=True)
-        exponential = np.exp(logits3d - max_along_axis)
-        denominator = np.sum(exponential, axis=heatmap_axes, keepdims=True)
-        res = exponential / denominator
-
-        # 3D Decode Heatmap
-        result = []
-        for ax in heatmap_axes:
-            other_heatmap_axes = tuple(other_ax for other_ax in heatmap_axes if other_ax != ax)
-            summed_over_other_heatmap_axes = np.sum(res, axis=other_heatmap_axes, keepdims=True)
-            coords = np.linspace(0.0, 1.0, res.shape[ax])
-            decoded = np.tensordot(summed_over_other_heatmap_axes, coords, axes=[[ax], [0]])
-            result.append(np.squeeze(np.expand_dims(decoded, ax), axis=heatmap_axes))
-        pred3d = np.stack(result, axis=-1)
-
-        # 2D Softmax
-        heatmap_axes = (2, 1)
-        max_along_axis = logits2d.max(axis=heatmap_axes, keepdims=True)
-        exponential = np.exp(logits2d - max_along_axis)
-        denominator = np.sum(exponential, axis=heatmap_axes, keepdims=True)
-        res = exponential / denominator
-
-        # Decode heatmap
-        result = []
-        for ax in heatmap_axes:
-            other_heatmap_axes = tuple(other_ax for other_ax in heatmap_axes if other_ax != ax)
-            summed_over_other_heatmap_axes = np.sum(res, axis=other_heatmap_axes, keepdims=True)
-            coords = np.linspace(0.0, 1.0, res.shape[ax])
-            decoded = np.tensordot(summed_over_other_heatmap_axes, coords, axes=[[ax], [0]])
-            result.append(np.squeeze(np.expand_dims(decoded, ax), axis=heatmap_axes))
-        pred2d = np.stack(result, axis=-1) * 255
+        pred2d, pred3d = self.decoder(logits)
+        sw.lap("hpe.decode")
 
         # Get absolute position (if desired)
         is_predicted_to_be_in_fov = is_within_fov(pred2d)
 
         # If less than 1/3 of the joints is visible, then the resulting pose will be weird
         if is_predicted_to_be_in_fov.sum() < is_predicted_to_be_in_fov.size/4:
+            sw.lap("hpe.postprocess")
             return None
 
         # Move the skeleton into estimated absolute position if necessary
@@ -167,6 +273,7 @@ class HumanPoseEstimator:
             edges = None
 
         pred3d = pred3d[0]  # Remove batch dimension
+        sw.lap("hpe.postprocess")
 
         return {"pose": pred3d,
                 "edges": edges,
@@ -175,6 +282,7 @@ class HumanPoseEstimator:
 
 if __name__ == "__main__":
     import pycuda.autoinit  # IMPORTANT leave this here! It creates the context for CUDA
+    from utils.matplotlib_visualizer import MPLPosePrinter
     args = MainConfig()
     vis = MPLPosePrinter()
 
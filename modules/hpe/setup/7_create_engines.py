@@ -1,7 +1,7 @@
 import numpy as np
 from polygraphy.backend.trt import CreateConfig, EngineFromNetwork, NetworkFromOnnxPath, SaveEngine, TrtRunner
 
-BATCH_SIZE = 1
+BATCH_SIZE = 1  # Crops per call, MetrabsTRTConfig.batch_size must be the same
 
 
 def create_engine(in_path, out_path, inputs):
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def iou(a, b):
+    """
+    Intersection over union of two boxes in the (x1, x2, y1, y2) format of HumanPoseEstimator
+    """
+    w = min(a[1], b[1]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[2], b[2])
+    if w <= 0 or h <= 0:
+        return 0.
+    inter = w * h
+    union = (a[1] - a[0]) * (a[3] - a[2]) + (b[1] - b[0]) * (b[3] - b[2]) - inter
+    return inter / union if union > 0 else 0.
+
+
+class Tracker:
+    """
+    Give a persistent id to the humans estimated in consecutive frames, by greedy matching of their boxes.
+    When two pairs have the same overlap, the one whose root joints are closer wins
+    """
+    def __init__(self, args):
+        self.min_iou = args.track_iou
+        self.max_age = args.track_max_age
+        self.tracks = {}  # id: (last human, frames since last seen)
+        self.next_id = 0
+        self.lost = []  # Ids of the tracks dropped by the last update
+
+    def update(self, humans):
+        """
+        It receives the list of humans of the new frame and returns the list of their ids, in the same order
+        """
+        pairs = []
+        for track_id, (last, _) in self.tracks.items():
+            for i, human in enumerate(humans):
+                overlap = iou(last["bbox"], human["bbox"])
+                if overlap >= self.min_iou:
+                    distance = 0.
+                    if last.get("pose") is not None and human.get("pose") is not None:
+                        distance = np.linalg.norm(last["pose"][0] - human["pose"][0])
+                    pairs.append((-overlap, distance, track_id, i))
+        pairs.sort()
+
+        ids = [None] * len(humans)
+        matched = set()
+        for _, _, track_id, i in pairs:
+            if track_id in matched or ids[i] is not None:
+                continue
+            ids[i] = track_id
+            matched.add(track_id)
+
+        self.lost = []
+        for track_id in list(self.tracks.keys()):
+            if track_id not in matched:
+                last, age = self.tracks[track_id]
+                if age + 1 > self.max_age:
+                    self.tracks.pop(track_id)
+                    self.lost.append(track_id)
+                else:
+                    self.tracks[track_id] = (last, age + 1)
+        for i, human in enumerate(humans):
+            if ids[i] is None:
+                ids[i] = self.next_id
+                self.next_id += 1
+            self.tracks[ids[i]] = (human, 0)
+        return ids
@@ -0,0 +1,110 @@
+import timeit
+import numpy as np
+from modules.hpe.utils.detection import nms, postprocess_detections
+
+
+"""
+Compare postprocess_detections with the postprocessing it replaced (postprocess_yolo_output + nms_cpu, golden
+output) on synthetic YOLO outputs (4032 boxes, 80 classes, a few humans each detected by many anchors) and time both.
+Run from the root of the repository with: python -m modules.hpe.utils.check_detection
+"""
+
+
+def reference_nms(boxes, confs, nms_thresh=0.7, min_mode=False):
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    areas = (x2 - x1) * (y2 - y1)
+    order = confs.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        idx_self = order[0]
+        idx_other = order[1:]
+
+        keep.append(idx_self)
+
+        xx1 = np.maximum(x1[idx_self], x1[idx_other])
+        yy1 = np.maximum(y1[idx_self], y1[idx_other])
+        xx2 = np.minimum(x2[idx_self], x2[idx_other])
+        yy2 = np.minimum(y2[idx_self], y2[idx_other])
+
+        w = np.maximum(0.0, xx2 - xx1)
+        h = np.maximum(0.0, yy2 - yy1)
+        inter = w * h
+
+        if min_mode:
+            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
+        else:
+            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
+
+        inds = np.where(over <= nms_thresh)[0]
+        order = order[inds + 1]
+
+    return np.array(keep)
+
+
+def reference_postprocess(boxes, confidences, conf_thresh=0.3, nms_thresh=0.7):
+    """
+    Humans by decreasing confidence, as HumanPoseEstimator.detect got them
+    """
+    boxes = boxes.reshape(1, -1, 4)
+    confidences = confidences.reshape(1, -1, 80)
+    max_conf = np.max(confidences, axis=2)
+    max_id = np.argmax(confidences, axis=2)
+    argwhere = max_conf[0] > conf_thresh
+    l_box_array = boxes[0, argwhere, :]
+    l_max_conf = max_conf[0, argwhere]
+    l_max_id = max_id[0, argwhere]
+    cls_argwhere = l_max_id == 0
+    ll_box_array = l_box_array[cls_argwhere, :]
+    ll_max_conf = l_max_conf[cls_argwhere]
+    keep = reference_nms(ll_box_array, ll_max_conf, nms_thresh=nms_thresh)
+    humans = [[*ll_box_array[k], ll_max_conf[k], 0] for k in keep]
+    humans.sort(key=lambda x: x[4], reverse=True)
+    return np.array(humans, np.float32).reshape(-1, 6)
+
+
+def synthetic_output(rng, n_humans, n_objects=3, anchors=40):
+    """
+    Low confidences everywhere, and humans (class 0) and other objects each found by many jittered anchors
+    """
+    boxes = rng.uniform(0., 1., (4032, 2))
+    boxes = np.concatenate([boxes, boxes + rng.uniform(0.02, 0.3, (4032, 2))], axis=1)
+    confidences = rng.uniform(0., 0.05, (4032, 80))
+    for k in range(n_humans + n_objects):
+        center, size = rng.uniform(0.2, 0.8, 2), rng.uniform(0.1, 0.4, 2)
+        idx = rng.choice(4032, anchors, replace=False)
+        jitter = rng.normal(0., 0.02, (anchors, 4))
+        boxes[idx] = np.concatenate([center - size / 2, center + size / 2]) + jitter
+        confidences[idx, 0 if k < n_humans else rng.integers(1, 80)] = rng.uniform(0.2, 0.95, anchors)
+    return boxes.astype(np.float32)[None], confidences.astype(np.float32)[None]
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for n_humans in [0, 1, 3, 6]:
+        for _ in range(20):
+            boxes, confidences = synthetic_output(rng, n_humans)
+            reference = reference_postprocess(boxes, confidences)
+            humans = postprocess_detections(boxes, confidences, top_k=None)[0]
+            assert np.allclose(humans, reference), (humans, reference)
+            if (confidences[0].argmax(axis=1) == 0).sum() <= 100:  # Then top_k changes nothing
+                assert np.array_equal(postprocess_detections(boxes, confidences, top_k=100)[0], humans)
+    pixels = rng.integers(0, 400, (50, 2))
+    pixels = np.concatenate([pixels, pixels + rng.integers(10, 100, (50, 2))], axis=1)
+    scores = rng.uniform(0., 1., 50)
+    reference = reference_nms(pixels, scores, nms_thresh=0.01)
+    reference = reference[scores[reference] > 0.8]
+    assert np.array_equal(nms(pixels, scores, nms_thresh=0.01, score_thresh=0.8), reference)
+    print("Same output as the reference")
+
+    n = 500
+    for n_humans in [1, 6]:
+        boxes, confidences = synthetic_output(rng, n_humans)
+        reference = timeit.timeit(lambda: reference_postprocess(boxes, confidences), number=n) / n
+        vectorized = timeit.timeit(lambda: postprocess_detections(boxes, confidences), number=n) / n
+        print(f"{n_humans} humans: reference {reference * 1e6:.0f} us, postprocess_detections {vectorized * 1e6:.0f} us "
+              f"({reference / vectorized:.1f}x)")
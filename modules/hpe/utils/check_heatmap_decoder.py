@@ -0,0 +1,73 @@
+import timeit
+import einops
+import numpy as np
+from modules.hpe.utils.heatmap_decoder import HeatmapDecoder
+
+
+"""
+Compare HeatmapDecoder with the decoding it replaced in HumanPoseEstimator (golden output) and time both.
+Run from the root of the repository with: python -m modules.hpe.utils.check_heatmap_decoder
+"""
+
+
+def reference_decode(logits):
+    _, logits2d, logits3d = np.split(logits, [0, 32], axis=3)
+    current_format = 'b h w (d j)'
+    logits3d = einops.rearrange(logits3d, f'{current_format} -> b h w d j', j=32)  # 5, 8, 8, 9, 32
+
+    # 3D Softmax
+    heatmap_axes = (2, 1, 3)
+    max_along_axis = logits3d.max(axis=heatmap_axes, keepdims=True)
+    exponential = np.exp(logits3d - max_along_axis)
+    denominator = np.sum(exponential, axis=heatmap_axes, keepdims=True)
+    res = exponential / denominator
+
+    # 3D Decode Heatmap
+    result = []
+    for ax in heatmap_axes:
+        other_heatmap_axes = tuple(other_ax for other_ax in heatmap_axes if other_ax != ax)
+        summed_over_other_heatmap_axes = np.sum(res, axis=other_heatmap_axes, keepdims=True)
+        coords = np.linspace(0.0, 1.0, res.shape[ax])
+        decoded = np.tensordot(summed_over_other_heatmap_axes, coords, axes=[[ax], [0]])
+        result.append(np.squeeze(np.expand_dims(decoded, ax), axis=heatmap_axes))
+    pred3d = np.stack(result, axis=-1)
+
+    # 2D Softmax
+    heatmap_axes = (2, 1)
+    max_along_axis = logits2d.max(axis=heatmap_axes, keepdims=True)
+    exponential = np.exp(logits2d - max_along_axis)
+    denominator = np.sum(exponential, axis=heatmap_axes, keepdims=True)
+    res = exponential / denominator
+
+    # Decode heatmap
+    result = []
+    for ax in heatmap_axes:
+        other_heatmap_axes = tuple(other_ax for other_ax in heatmap_axes if other_ax != ax)
+        summed_over_other_heatmap_axes = np.sum(res, axis=other_heatmap_axes, keepdims=True)
+        coords = np.linspace(0.0, 1.0, res.shape[ax])
+        decoded = np.tensordot(summed_over_other_heatmap_axes, coords, axes=[[ax], [0]])
+        result.append(np.squeeze(np.expand_dims(decoded, ax), axis=heatmap_axes))
+    pred2d = np.stack(result, axis=-1) * 255
+    return pred2d, pred3d
+
+
+if __name__ == "__main__":
+    decoder = HeatmapDecoder()
+    rng = np.random.default_rng(0)
+    for b in [1, 5]:
+        for scale in [1., 10.]:  # Flat and peaked heatmaps
+            logits = (rng.normal(size=(b, 8, 8, 288)) * scale).astype(np.float32)
+            ref2d, ref3d = reference_decode(logits)
+            pred2d, pred3d = decoder(logits)
+            assert pred2d.shape == ref2d.shape and pred3d.shape == ref3d.shape
+            assert np.allclose(pred2d, ref2d, atol=1e-3), np.abs(pred2d - ref2d).max()
+            assert np.allclose(pred3d, ref3d, atol=1e-5), np.abs(pred3d - ref3d).max()
+    print("Same output as the reference")
+
+    for b in [1, 5]:
+        logits = rng.normal(size=(b, 8, 8, 288)).astype(np.float32)
+        n = 2000
+        reference = timeit.timeit(lambda: reference_decode(logits), number=n) / n
+        fused = timeit.timeit(lambda: decoder(logits), number=n) / n
+        print(f"Batch {b}: reference {reference * 1e6:.1f} us, HeatmapDecoder {fused * 1e6:.1f} us "
+              f"({reference / fused:.1f}x)")
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+"""
+Postprocessing of the detectors on arrays: early filtering of the scores, top-k pre-selection and NMS.
+The YOLO of HPE gives, for each image, 4032 boxes (x1, y1, x2, y2 normalized) with the confidences of 80 classes
+(class 0 is person), the head detectors of mutual gaze give boxes in pixels with their score
+"""
+
+
+def overlaps(boxes, min_mode=False):
+    """
+    Pairwise IoU of n boxes, n n (with min_mode, the intersection is divided by the smallest area)
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    w = np.maximum(0., np.minimum(x2[:, None], x2[None]) - np.maximum(x1[:, None], x1[None]))
+    h = np.maximum(0., np.minimum(y2[:, None], y2[None]) - np.maximum(y1[:, None], y1[None]))
+    inter = w * h
+    with np.errstate(divide="ignore", invalid="ignore"):  # Empty boxes overlap nothing
+        if min_mode:
+            return inter / np.minimum(areas[:, None], areas[None])
+        return inter / (areas[:, None] + areas[None] - inter)
+
+
+def nms(boxes, scores, nms_thresh=0.7, score_thresh=None, top_k=None, min_mode=False):
+    """
+    Indices of the boxes kept by non-maximum suppression, by decreasing score. The boxes not over score_thresh are
+    dropped first (they could only suppress boxes with a lower score), then only the top_k best ones are considered.
+    The overlaps are computed once, the loop runs once for each kept box
+    """
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    scores = np.asarray(scores).reshape(-1)
+    candidates = np.arange(len(scores)) if score_thresh is None else np.flatnonzero(scores > score_thresh)
+    if top_k is not None and len(candidates) > top_k:
+        candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+    candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+    suppress = overlaps(boxes[candidates], min_mode) > nms_thresh
+    alive = np.ones(len(candidates), bool)
+    keep = []
+    while alive.any():
+        i = np.argmax(alive)
+        keep.append(i)
+        alive &= ~suppress[i]
+        alive[i] = False
+    return candidates[np.array(keep, int)]
+
+
+def postprocess_detections(boxes, confidences, conf_thresh=0.3, nms_thresh=0.7, classes=(0,), top_k=100):
+    """
+    Detections of a batch of images, from b n 4 boxes and b n c confidences. A box is a detection of its most
+    confident class if that class is in classes and the confidence is over conf_thresh. It returns, for each image,
+    an array of detections (x1, y1, x2, y2, confidence, class) by decreasing confidence, after NMS within each class
+    of the top_k candidates
+    """
+    b = boxes.shape[0]
+    boxes = boxes.reshape(b, -1, 4)
+    confidences = confidences.reshape(b, boxes.shape[1], -1)
+    classes = np.asarray(classes)
+    results = []
+    for i in range(b):
+        # Only the confidences of the wanted classes are read for all the boxes
+        candidates = np.flatnonzero((confidences[i][:, classes] > conf_thresh).any(axis=1))
+        ids = confidences[i, candidates].argmax(axis=1)
+        scores = confidences[i, candidates, ids]
+        wanted = np.isin(ids, classes)
+        candidates, ids, scores = candidates[wanted], ids[wanted], scores[wanted]
+
+        # Boxes of different classes are moved apart, so that a single NMS never compares them
+        image_boxes = boxes[i, candidates]
+        span = image_boxes.max() - image_boxes.min() + 1 if len(candidates) > 0 else 0
+        keep = nms(image_boxes + (ids * span)[:, None], scores, nms_thresh, top_k=top_k)
+        results.append(np.concatenate([image_boxes[keep], scores[keep, None], ids[keep, None]],
+                                      axis=1).astype(np.float32))
+    return results
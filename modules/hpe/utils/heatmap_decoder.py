@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class HeatmapDecoder:
+    """
+    Soft-argmax of the heads of MeTRAbs, in float32 and for a batch of crops.
+    The 288 channels of each cell are (slot, joint): slot 0 is the 2D heatmap, slots 1 to depth the 3D one.
+    Both softmaxes are a single exp of the logits, and their expected coordinates and normalizations are a single
+    product with a grid computed once
+    """
+    def __init__(self, height=8, width=8, depth=8, n_joints=32, side=255):
+        self.shape = (height, width, depth + 1, n_joints)
+        self.side = side  # The 2D poses are in pixels of the crop
+        x = np.linspace(0., 1., width, dtype=np.float32)
+        y = np.linspace(0., 1., height, dtype=np.float32)
+        z = np.linspace(0., 1., depth, dtype=np.float32)
+        grid = np.zeros((height, width, depth + 1, 7), np.float32)
+        grid[:, :, 0, 0] = x[None, :]  # 2D: x, y, normalization
+        grid[:, :, 0, 1] = y[:, None]
+        grid[:, :, 0, 2] = 1.
+        grid[:, :, 1:, 3] = x[None, :, None]  # 3D: x, y, z, normalization
+        grid[:, :, 1:, 4] = y[:, None, None]
+        grid[:, :, 1:, 5] = z[None, None, :]
+        grid[:, :, 1:, 6] = 1.
+        self.grid_t = np.ascontiguousarray(grid.reshape(-1, 7).T)  # 7 (h w slot)
+
+    def __call__(self, logits):
+        """
+        It receives the logits of the heads, b 8 8 288, and returns the 2D poses (b j 2, in pixels) and the 3D poses
+        (b j 3, normalized in the cube of the crop)
+        """
+        b = logits.shape[0]
+        logits = np.asarray(logits, np.float32).reshape(b, -1, *self.shape[2:])  # b (h w) slot j
+        shift = np.empty((b, 1, *self.shape[2:]), np.float32)
+        shift[:, 0, 0] = logits[:, :, 0].max(axis=1)
+        shift[:, 0, 1:] = logits[:, :, 1:].max(axis=(1, 2))[:, None]
+        exponential = np.exp(logits - shift).reshape(b, -1, self.shape[3])  # b (h w slot) j
+        sums = self.grid_t @ exponential  # b 7 j
+        pred2d = np.stack([sums[:, 0], sums[:, 1]], axis=-1) / sums[:, 2, :, None] * self.side
+        pred3d = np.stack([sums[:, 3], sums[:, 4], sums[:, 5]], axis=-1) / sums[:, 6, :, None]
+        return pred2d, pred3d
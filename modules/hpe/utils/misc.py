@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 import einops
 
@@ -24,87 +25,15 @@ import einops
 #     return intersection_area > 0.5 * box_area
 
 
-def nms_cpu(boxes, confs, nms_thresh=0.7, min_mode=False):
-    # print(boxes.shape)
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-
-    areas = (x2 - x1) * (y2 - y1)
-    order = confs.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        idx_self = order[0]
-        idx_other = order[1:]
-
-        keep.append(idx_self)
-
-        xx1 = np.maximum(x1[idx_self], x1[idx_other])
-        yy1 = np.maximum(y1[idx_self], y1[idx_other])
-        xx2 = np.minimum(x2[idx_self], x2[idx_other])
-        yy2 = np.minimum(y2[idx_self], y2[idx_other])
-
-        w = np.maximum(0.0, xx2 - xx1)
-        h = np.maximum(0.0, yy2 - yy1)
-        inter = w * h
-
-        if min_mode:
-            over = inter / np.minimum(areas[order[0]], areas[order[1:]])
-        else:
-            over = inter / (areas[order[0]] + areas[order[1:]] - inter)
-
-        inds = np.where(over <= nms_thresh)[0]
-        order = order[inds + 1]
-
-    return np.array(keep)
-
-
-def postprocess_yolo_output(boxes, confidences, conf_thresh=0.3, nms_thresh=0.7, num_classes=1):
-    # Reshape output
-    boxes = boxes.reshape(1, -1, 1, 4)  # 1 4032 1 4
-    boxes = boxes[:, :, 0]  # 1 4032 4
-    confidences = confidences.reshape(1, -1, 80)  # 1 4032 80
-    nums_classes = confidences.shape[2]  # 80
-
-    # Get maximum confidences
-    max_conf = np.max(confidences, axis=2)
-    max_id = np.argmax(confidences, axis=2)
-
-    # Loop over batches to get results
-    bboxes_batch = []
-    for i in range(boxes.shape[0]):  # 1
-
-        # Get boxes, confidences and ids of the detection in this image of the batch
-        argwhere = max_conf[i] > conf_thresh
-        l_box_array = boxes[i, argwhere, :]
-        l_max_conf = max_conf[i, argwhere]
-        l_max_id = max_id[i, argwhere]
-
-        # Loop over the possible classes
-        bboxes = []
-        for j in range(num_classes):
-
-            # Get boxes, confidences and ids of the classes in this image of the batch
-            cls_argwhere = l_max_id == j
-            ll_box_array = l_box_array[cls_argwhere, :]
-            ll_max_conf = l_max_conf[cls_argwhere]
-            ll_max_id = l_max_id[cls_argwhere]
-
-            # Keep only detection which has certain criterion
-            keep = nms_cpu(ll_box_array, ll_max_conf, nms_thresh=nms_thresh)
-            if keep.size > 0:
-                ll_box_array = ll_box_array[keep, :]
-                ll_max_conf = ll_max_conf[keep]
-                ll_max_id = ll_max_id[keep]
-                for k in range(ll_box_array.shape[0]):
-                    bboxes.append(
-                        [ll_box_array[k, 0], ll_box_array[k, 1], ll_box_array[k, 2], ll_box_array[k, 3],
-                         ll_max_conf[k], ll_max_id[k]])
-
-        bboxes_batch.append(bboxes)
-    return bboxes_batch
+def preprocess_yolo(frame, out):
+    """
+    Resize a BGR frame and write it into out (1 3 h w float32, e.g. the input buffer of the engine) as planar RGB in
+    [0, 1]: the frame is read once by the resize, then each channel of the small image is written in place
+    """
+    square_img = cv2.resize(frame, out.shape[:1:-1], interpolation=cv2.INTER_AREA)
+    for c in range(3):
+        np.multiply(square_img[:, :, 2 - c], np.float32(1 / 255.), out=out[0, c])
+    return out
 
 
 # TODO DEBUG TRYING TO ADD METRABS FUNCTION
@@ -170,9 +99,11 @@ def reconstruct_ref_fullpersp(normalized_2d, coords3d_rel, validity_mask):
     weights = validity_mask.astype(np.float32) + np.float32(1e-4)
     weights = einops.repeat(weights, 'b j -> b (j c) 1', c=2)
 
-    i = 0  # TODO we just select one element!
-    ref = np.linalg.lstsq((A * weights)[i], (b * weights)[i], rcond=None)[0].T
-    ref = np.concatenate([ref[:, :2], ref[:, 2:] / scale2d[i]], axis=1) * scale_rel_backproj[i]
+    # Least squares of every element of the batch at once, through the normal equations of its 3 unknowns
+    A, b = A * weights, b * weights
+    At = A.swapaxes(1, 2)
+    ref = np.linalg.solve(At @ A, At @ b)[..., 0]
+    ref = np.concatenate([ref[:, :2], ref[:, 2:] / scale2d], axis=1) * scale_rel_backproj
     return ref
     # return np.squeeze(ref, axis=-1)
 
@@ -1,7 +1,8 @@
 import copy
 import cv2
 import pickle
-from modules.hpe.utils.misc import postprocess_yolo_output, homography, get_augmentations, is_within_fov, reconstruct_absolute
+from modules.hpe.utils.misc import homography, get_augmentations, is_within_fov, reconstruct_absolute
+from modules.hpe.utils.detection import postprocess_detections
 import einops
 import numpy as np
 from utils.input import RealSense
@@ -29,8 +30,8 @@ class HumanPoseEstimator:
 
         # Yolo
         outputs = self.yolo(yolo_in)
-        boxes, confidences = outputs[0].reshape(1, 4032, 1, 4), outputs[1].reshape(1, 4032, 80)
-        bboxes_batch = postprocess_yolo_output(boxes, confidences, self.yolo_thresh, self.nms_thresh)
+        boxes, confidences = outputs[0].reshape(1, 4032, 4), outputs[1].reshape(1, 4032, 80)
+        bboxes_batch = postprocess_detections(boxes, confidences, self.yolo_thresh, self.nms_thresh)
         return
 
 
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import queue
+import time
+import cv2
+from main import ISBFSAR
+from utils.clock import Clock, VirtualClock
+from utils.params import MainConfig
+
+
+"""
+Feed a recorded session (video file or directory of images) through ISBFSAR, without manager, source and VISPY.
+Frames are timestamped at the recorded rate: by default they are processed as fast as possible on a virtual clock,
+so that the results do not depend on the machine, with --realtime they arrive at the recorded rate on the wall clock.
+Commands can be given at a frame index, e.g. --command 30 "add wave" --command 200 "save"
+Every output (and its timing) and every answer to a command is written as a JSON line, the summary is printed at the end.
+"""
+
+
+class ReplaySource:
+    """
+    Queue-like source for ISBFSAR that behaves like a camera on the given clock: if the clock moved past the next
+    frame, the current one is dropped, unless a command is scheduled on it. Without block, queue.Empty is raised if
+    the next frame is not captured yet. At the end it keeps returning the last frame (queue.Empty without block)
+    """
+    def __init__(self, path, clock, width, height, fps=None, commands=None):
+        self.clock = clock
+        self.size = (width, height)
+        self.commands = commands if commands is not None else {}
+        if os.path.isdir(path):
+            self.video = None
+            self.files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                                if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+            self.fps = fps if fps is not None else 30.
+        else:
+            self.video = cv2.VideoCapture(path)
+            self.fps = fps if fps is not None else (self.video.get(cv2.CAP_PROP_FPS) or 30.)
+        self.start = None  # Clock time of the first frame, set when it is read
+        self.index = 0
+        self.dropped = 0
+        self.last = None
+        self.finished = False
+
+    def _read(self):
+        if self.video is not None:
+            ok, img = self.video.read()
+        else:
+            ok = self.index < len(self.files)
+            img = cv2.imread(self.files[self.index]) if ok else None
+        if ok:
+            self.index += 1
+            img = cv2.resize(img, self.size)
+        return ok, img
+
+    def get(self, block=True, timeout=None):
+        if not block and (self.finished or (self.start is not None and
+                                            self.clock.time() < self.start + self.index / self.fps)):
+            raise queue.Empty
+        while True:
+            ok, img = self._read()
+            if not ok:
+                self.finished = True
+                return {"rgb": self.last, "ts": self.clock.time()}
+            i = self.index - 1
+            if self.start is None:
+                self.start = self.clock.time()
+            ts = self.start + i / self.fps
+            if self.clock.time() >= ts + 1. / self.fps and i not in self.commands.keys():  # Next one already there
+                self.dropped += 1
+                continue
+            self.clock.sleep(ts - self.clock.time())  # Wait for the capture
+            self.last = img
+            return {"rgb": img, "ts": ts, "id": i}
+
+
+class ReplayCommands:
+    """
+    Queue-like command channel for ISBFSAR, that gives each command once its frame is read and close at the end
+    """
+    def __init__(self, source):
+        self.source = source
+        self.given = set()
+
+    def get(self, block=True, timeout=None):
+        if self.source.finished:
+            return {"command": "close"}
+        for frame in sorted(self.source.commands.keys()):  # Also the ones of frames dropped by ingestion
+            if frame < self.source.index and frame not in self.given:
+                self.given.add(frame)
+                return {"id": frame, "command": self.source.commands[frame]}
+        raise queue.Empty
+
+
+class ReplaySink:
+    """
+    Queue-like output for ISBFSAR that writes the results as JSON lines
+    """
+    def __init__(self, path, source):
+        self.outfile = open(path, 'w')
+        self.source = source
+        self.results = 0
+        self.start = None  # Wall time of the first result, model loading is not part of the throughput
+
+    def put(self, elements, block=True, timeout=None):
+        if "command" in elements.keys():  # Answer to a command
+            self.outfile.write(json.dumps(elements) + '\n')
+            return
+        if self.start is None:
+            self.start = time.time()
+        record = {k: v for k, v in elements.items() if k not in ["img", "img_preprocessed", "preview"]}
+        if "ts" in record.keys():
+            record["frame"] = int(round((record["ts"] - self.source.start) * self.source.fps))
+        self.outfile.write(json.dumps(record, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)))
+        self.outfile.write('\n')
+        self.results += 1
+
+    def close(self):
+        self.outfile.close()
+        elapsed = time.time() - self.start if self.start is not None else 0.
+        if self.results < 2:
+            return
+        print(f"{self.results} results from {self.source.index} frames ({self.source.dropped} dropped) "
+              f"in {elapsed:.2f}s: {(self.results - 1) / elapsed:.2f} fps")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="video file or directory of images")
+    parser.add_argument("--output", default=os.path.join("assets", "replay.jsonl"))
+    parser.add_argument("--fps", type=float, default=None, help="recorded rate, needed for directories of images")
+    parser.add_argument("--realtime", action="store_true", help="feed frames at the recorded rate")
+    parser.add_argument("--command", nargs=2, action="append", default=[], metavar=("FRAME", "COMMAND"))
+    opts = parser.parse_args()
+
+    args = MainConfig()
+    if not opts.realtime:  # The deadlines are on the wall clock, a result must not depend on how fast the machine is
+        args.hpe_deadline = None
+        args.focus_deadline = None
+    clock = Clock() if opts.realtime else VirtualClock()
+    source = ReplaySource(opts.path, clock, args.cam_width, args.cam_height, fps=opts.fps,
+                          commands={int(f): c for f, c in opts.command})
+    sink = ReplaySink(opts.output, source)
+    master = ISBFSAR(args, visualizer=False, video_input=source, output=sink, clock=clock,
+                     command_input=ReplayCommands(source), command_output=sink)
+    master.run()
+    sink.close()
+    os._exit(0)  # HPE and focus processes never return
@@ -0,0 +1,72 @@
+import queue
+import time
+from collections import deque
+from loguru import logger
+from main import ISBFSAR, Workers, startup_report
+from modules.ar.ar import inference_streams
+from utils.params import MainConfig
+
+
+"""
+Serve several cameras with a single set of HPE and focus workers and a single TRXOS.
+Each camera runs its own source.py with --stream NAME (one of MainConfig.streams) and keeps its own support set,
+windows, command channel and enrollment. The frames of different streams collected together are scored by action
+recognition in the same forward.
+"""
+
+
+class InferenceServer:
+    def __init__(self, args, streams):
+        self.pipeline_depth = args.pipeline_depth
+        self.workers = Workers(args, n_streams=len(streams))
+        self.streams = {}
+        model = None
+        for name in streams:
+            self.streams[name] = ISBFSAR(args, workers=self.workers, model=model, stream=name)
+            model = self.streams[name].ar.ar
+        logger.info(startup_report(self.streams[streams[0]].startup, self.workers.wait_ready()))
+        self.in_flight = deque()  # Streams of the frames in flight, in order of submission
+
+    def collect(self, keep):
+        """
+        Emit the oldest frames until at most keep are in flight. The workers answer in order of submission,
+        so frames are received in the same order, one for each stream at most in each forward
+        """
+        while len(self.in_flight) > keep:
+            frames = []
+            while len(self.in_flight) > keep and self.in_flight[0] not in [name for name, _ in frames]:
+                name = self.in_flight.popleft()
+                frames.append((name, self.streams[name].receive()))
+            results = inference_streams({name: (self.streams[name].ar, frame["inputs"]) for name, frame in frames
+                                         if self.streams[name].ar_due(frame["inputs"])})
+            for name, frame in frames:
+                self.streams[name].emit(frame, results.get(name))
+
+    def run(self):
+        while len(self.streams) > 0:
+            got = False
+            for name, stream in list(self.streams.items()):
+                try:
+                    data = stream.ingest(block=False)
+                except queue.Empty:
+                    continue
+                got = True
+                if stream.closing.is_set():  # The other streams go on
+                    stream.release_input(data)
+                    self.collect(0)
+                    self.streams.pop(name)
+                    continue
+                stream.submit(data["rgb"], data.get("ts"), data.get("id"), data)
+                self.in_flight.append(name)
+            self.collect(max(self.pipeline_depth * len(self.streams) - 1, 0))
+            if not got:
+                time.sleep(0.001)
+
+        self.collect(0)
+        self.workers.close()
+
+
+if __name__ == "__main__":
+    args = MainConfig()
+    server = InferenceServer(args, args.streams)
+    server.run()
@@ -1,33 +1,59 @@
-import copy
+import argparse
 import multiprocessing
+import queue
+import time
 from multiprocessing import Queue, Process
-from multiprocessing.managers import BaseManager
 from typing import Dict, Union
 from utils.input import RealSense
 from utils.output import VISPYVisualizer
 from utils.params import MainConfig
+from utils.transport import get_transport, queue_name
+from utils.tracing import tracer
 
 
 """
 This module manages the input and the output of the whole program.
 It also manages the communication with the docker container.
 Input: frames from RealSense (camera.read()) or commands fom VISPY (input_queue.get())
-Output: frames from RealSense or commands fom VISPY (processes['src_to_sink'].put)
+Output: frames from RealSense (processes['source_human'].put) or commands fom VISPY (processes['source_command'].put)
+Input: answers to the commands (processes['command_source'].get()), shown with the next result
 Input: elements for VISPY to visualize (processes['sink_to_src'].get())
 Output: elements for VISPY to visualize (output_queue.send())
+With --stream NAME the camera is one of the streams of server.py (see MainConfig.streams)
+The camera is never blocked by the inference: when main.py is busy the new frame is dropped (the next one is newer),
+and only the newest result is kept for VISPY
 """
 
+
+def put_latest(q, item):
+    """
+    Put item in a queue of size 1, replacing the element that is still there
+    """
+    try:
+        q.put(item, block=False)
+    except queue.Full:
+        try:
+            q.get(block=False)
+        except queue.Empty:
+            pass
+        q.put(item)
+
+
 if __name__ == '__main__':
     multiprocessing.current_process().name = 'Source'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", default=None, help="name of the camera, when connecting to server.py")
+    opts = parser.parse_args()
 
-    processes: Dict[str, Union[Queue, None]] = {'source_human': None, 'human_sink': None}
+    processes: Dict[str, Union[Queue, None]] = {'source_human': None, 'human_sink': None,
+                                                'source_command': None, 'command_source': None}
 
-    BaseManager.register('get_queue')
-    manager = BaseManager(address=('localhost', 50000), authkey=b'abracadabra')
-    manager.connect()
+    tracer.configure("source" if opts.stream is None else f"source_{opts.stream}", MainConfig())
 
+    # With manager, manager.py must be running, otherwise main.py connects to this process
+    transport = get_transport(MainConfig(), listen=True, stream=opts.stream)
     for proc in processes:
-        processes[proc] = manager.get_queue(proc)
+        processes[proc] = transport.get_queue(queue_name(proc, opts.stream))
 
     # Create input (camera)
     camera = RealSense(width=MainConfig().cam_width, height=MainConfig().cam_height, fps=60)
@@ -40,15 +66,55 @@ if __name__ == '__main__':
     output_proc.start()
 
     elems = {}
+    commands = []  # Got from Vispy and not yet accepted by main
+    n_commands = 0
+    reply = None  # Answer to the last command, shown with the next result
+    dropped = 0
+    frame = 0
     while True:
         _, rgb = camera.read()
+        read_time = time.time()
+        capture_time = camera.timestamp if camera.timestamp is not None else read_time  # RealSense metadata
+        tracer.record("source.capture_to_read", capture_time, read_time, frame)
+
+        # Commands go on their own channel, main answers them without waiting for the frames
+        if not vispy_in_q.empty():
+            commands.append({"id": n_commands, "command": vispy_in_q.get()})
+            n_commands += 1
+        while len(commands) > 0:
+            try:
+                processes['source_command'].put(commands[0], block=False)
+                commands.pop(0)
+            except queue.Full:
+                break
+        try:
+            reply = processes['command_source'].get(block=False)["log"]
+        except queue.Empty:
+            pass
 
-        # Prepare inference with rgb and optional command got from Vispy
-        elems['rgb'] = copy.deepcopy(rgb)
-        elems['msg'] = '' if vispy_in_q.empty() else copy.deepcopy(vispy_in_q.get())
+        # Prepare inference with rgb (put copies or sends the frame right away)
+        elems['rgb'] = rgb
+        elems['ts'] = capture_time
+        elems['id'] = frame
+        elems['dropped'] = dropped
 
-        # Send to main
-        processes['source_human'].put(elems)
+        # Send to main, if it is still busy with the previous frame drop this one
+        start = time.time()
+        try:
+            processes['source_human'].put(elems, block=False)
+            tracer.record("source.send", start, time.time(), frame)
+            dropped = 0
+        except queue.Full:
+            dropped += 1
+        frame += 1
+        tracer.maybe_export()
 
         # Send results to visualizer
-        vispy_out_q.put(processes['human_sink'].get())
+        try:
+            res = processes['human_sink'].get(block=False)
+            if reply is not None:
+                res["log"] = reply
+                reply = None
+            put_latest(vispy_out_q, res)
+        except queue.Empty:
+            pass
@@ -0,0 +1,96 @@
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+import numpy as np
+from utils.transport import ManagerTransport, SocketTransport, SharedMemoryTransport
+
+
+"""
+Compare the transports between source.py and main.py: the source sends 640x480 frames at the given fps and the
+main answers with a small result for each frame, like in the real pipeline.
+Run from the root of the repository with: python -m utils.benchmark_transport
+The main side runs in an independent interpreter, as in the real setup
+"""
+
+WIDTH, HEIGHT, FPS, SECONDS = 640, 480, 60, 10
+MANAGER_ADDRESS = ('localhost', 50001)
+
+
+def serve_manager():
+    queues = defaultdict(lambda: queue.Queue(1))
+    BaseManager.register('get_queue', callable=lambda name: queues[name])
+    BaseManager(address=MANAGER_ADDRESS, authkey=b'abracadabra').get_server().serve_forever()
+
+
+def create(name, address, listen):
+    if name == "manager":
+        return ManagerTransport(MANAGER_ADDRESS)
+    if name == "socket":
+        return SocketTransport(address, listen)
+    return SharedMemoryTransport(address, listen)
+
+
+def main_side(name, address, n_frames):
+    transport = create(name, address, listen=False)
+    in_queue = transport.get_queue('source_human')
+    out_queue = transport.get_queue('human_sink')
+    for _ in range(n_frames):
+        data = in_queue.get()
+        out_queue.put({"ts": data["ts"], "pixel": int(data["rgb"][0, 0, 0])})
+    in_queue.get()  # The source got every result
+    if name != "manager":
+        in_queue.close()
+        out_queue.close()
+
+
+def run(name, fps):
+    address = os.path.join(tempfile.mkdtemp(), 'transport.sock')
+    n_frames = FPS * SECONDS
+    server = None
+    if name == "manager":
+        server = Process(target=serve_manager, daemon=True)
+        server.start()
+        time.sleep(1)
+    main_proc = subprocess.Popen([sys.executable, '-m', 'utils.benchmark_transport', name, address, str(n_frames)])
+
+    transport = create(name, address, listen=True)
+    in_queue = transport.get_queue('source_human')
+    out_queue = transport.get_queue('human_sink')
+    frames = np.random.randint(0, 255, (4, HEIGHT, WIDTH, 3), dtype=np.uint8)
+    latencies = []
+    start = time.time()
+    for i in range(n_frames):
+        tick = time.time()
+        in_queue.put({"rgb": frames[i % len(frames)], "msg": '', "ts": tick})
+        res = out_queue.get()
+        latencies.append(time.time() - res["ts"])
+        if fps is not None:  # Camera rate
+            time.sleep(max(0., (1. / fps) - (time.time() - tick)))
+    elapsed = time.time() - start
+    in_queue.put({"msg": "stop"})
+
+    main_proc.wait()
+    if name != "manager":
+        in_queue.close()
+        out_queue.close()
+    if server is not None:
+        server.terminate()
+    latencies = np.array(latencies) * 1000
+    print("{:>8} | {:>8} | {:8.2f} | {:8.2f} | {:8.2f}".format(
+        name, "max" if fps is None else fps, n_frames / elapsed, latencies.mean(), np.percentile(latencies, 95)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main_side(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+        sys.exit()
+    print("{:>8} | {:>8} | {:>8} | {:>8} | {:>8}".format("name", "target", "fps", "mean ms", "p95 ms"))
+    for target in [FPS, None]:
+        for transport_name in ["manager", "socket", "shm"]:
+            run(transport_name, target)
@@ -0,0 +1,29 @@
+import time
+
+
+class Clock:
+    """
+    Wall clock, used by the live pipeline
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    Starts from zero and advances only when someone sleeps (e.g. waiting for the next recorded frame),
+    so that a replay does not depend on how fast the machine is
+    """
+    def __init__(self):
+        self.now = 0.
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
@@ -36,6 +36,7 @@ class RealSense:
 
         self.configs = configs
         self.align = rs.align(rs.stream.depth)
+        self.timestamp = None  # Capture time (seconds, host clock) of the last frame, if the camera gives it
 
     def intrinsics(self):
         return self.profile.get_stream(rs.stream.depth).as_video_stream_profile().get_intrinsics()
@@ -48,6 +49,9 @@ class RealSense:
         # color_frame = aligned_frames.get_color_frame()
         # depth_frame = frames.get_depth_frame()  # aligned_depth_frame is a 640x480 depth image
         color_frame = frames.get_color_frame()
+        self.timestamp = None
+        if color_frame.get_frame_timestamp_domain() == rs.timestamp_domain.global_time:
+            self.timestamp = color_frame.get_timestamp() / 1000.
 
         # depth_image = np.asanyarray(depth_frame.get_data())
         color_image = np.asanyarray(color_frame.get_data())
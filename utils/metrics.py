@@ -0,0 +1,141 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from utils.tracing import tracer
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations with bounded memory: buckets grow geometrically from lowest to highest seconds,
+    so every recorded value is known with a relative error below precision
+    """
+    def __init__(self, lowest=1e-6, highest=100., precision=0.01):
+        self.lowest = lowest
+        self.log_base = math.log1p(precision)
+        self.counts = np.zeros(int(math.log(highest / lowest) / self.log_base) + 2, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def record(self, value):
+        idx = int(math.log(value / self.lowest) / self.log_base) + 1 if value > self.lowest else 0
+        self.counts[min(idx, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.
+        idx = int(np.searchsorted(np.cumsum(self.counts), math.ceil(self.count * p / 100.)))
+        return min(self.lowest * math.exp(idx * self.log_base), self.max)  # Upper bound of the bucket
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.sum / self.count if self.count > 0 else 0.,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+
+class Stopwatch:
+    """
+    Record consecutive sections of a function without nesting it into context managers.
+    Each section is also a span of the frame the process is working on (see utils/tracing.py)
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.frame = tracer.frame
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.registry.record(stage, now - self.last)
+        tracer.record_perf(stage, self.last, now, self.frame)
+        self.last = now
+
+
+class Metrics:
+    """
+    Per-stage latency histograms and gauges (last value of a state, e.g. the quality level) of one process,
+    periodically exported to a JSON or Prometheus text file (together with the spans of the tracer)
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.name = None
+        self.path = None
+        self.every = None
+        self.last_export = time.time()
+        self.lock = threading.RLock()  # Worker threads of main.py export too (see execution in MainConfig)
+
+    def configure(self, name, args):
+        tracer.configure(name, args)
+        self.name = name
+        self.every = args.metrics_every
+        if args.metrics_path is not None:
+            os.makedirs(args.metrics_path, exist_ok=True)
+            self.path = os.path.join(args.metrics_path, f"{name}.{args.metrics_format}")
+
+    def record(self, stage, seconds):
+        if stage not in self.histograms.keys():
+            self.histograms[stage] = LatencyHistogram()
+        self.histograms[stage].record(seconds)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def stopwatch(self):
+        return Stopwatch(self)
+
+    def summary(self):
+        return {stage: h.summary() for stage, h in list(self.histograms.items())}  # Worker threads can add stages
+
+    def to_prometheus(self):
+        lines = ["# TYPE isbfsar_stage_seconds summary"]
+        for stage, s in self.summary().items():
+            labels = f'process="{self.name}",stage="{stage}"'
+            for q in ["50", "95", "99"]:
+                lines.append(f'isbfsar_stage_seconds{{{labels},quantile="0.{q}"}} {s["p" + q]:.9f}')
+            lines.append(f'isbfsar_stage_seconds_sum{{{labels}}} {s["mean"] * s["count"]:.9f}')
+            lines.append(f'isbfsar_stage_seconds_count{{{labels}}} {s["count"]}')
+        lines.append("# TYPE isbfsar_gauge gauge")
+        for name, value in list(self.gauges.items()):
+            lines.append(f'isbfsar_gauge{{process="{self.name}",name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None):
+        path = self.path if path is None else path
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps({"process": self.name, "time": time.time(), "stages": self.summary(),
+                               "gauges": dict(self.gauges)}, indent=2)
+        with self.lock:
+            with open(path + ".tmp", "w") as outfile:  # Readers never see a half written file
+                outfile.write(text)
+            os.replace(path + ".tmp", path)
+        return path
+
+    def maybe_export(self):
+        tracer.maybe_export()
+        with self.lock:
+            if self.path is not None and time.time() - self.last_export > self.every:
+                self.export()
+                self.last_export = time.time()
+
+
+metrics = Metrics()  # Registry of the current process
@@ -3,6 +3,9 @@ from vispy import app, scene, visuals
 from vispy.scene.visuals import Text, Image
 import numpy as np
 import math
+import time
+from utils.params import MainConfig
+from utils.tracing import tracer
 
 
 def get_color(value):
@@ -36,6 +39,7 @@ class VISPYVisualizer:
 
     @staticmethod
     def create_visualizer(qi, qo):
+        tracer.configure("vispy", MainConfig())
         _ = VISPYVisualizer(qi, qo)
         app.run()
 
@@ -43,6 +47,7 @@ class VISPYVisualizer:
 
         self.input_queue = input_queue
         self.output_queue = output_queue
+        self.last_img = None  # Last preview of the frame, results may come without it
         self.show = True
 
         self._timer = app.Timer('auto', connect=self.on_timer, start=True)
@@ -92,6 +97,9 @@ class VISPYVisualizer:
         self.fps = Text('', color='white', rotation=0, anchor_x="center", anchor_y="bottom",
                         font_size=12, pos=(0.75, 0.9))
         self.b2.add(self.fps)
+        self.ingestion = Text('', color='white', rotation=0, anchor_x="center", anchor_y="bottom",
+                              font_size=8, pos=(0.75, 0.85))
+        self.b2.add(self.ingestion)
         # Actions (LABEL OF INFO)
         self.fsscore = Text('fs score', color='white', rotation=0, anchor_x="center", anchor_y="bottom",
                             font_size=12, pos=(5/8, 0.75))
@@ -122,7 +130,7 @@ class VISPYVisualizer:
         b4.camera = scene.PanZoomCamera(rect=(0, 0, 1, 1))
         b4.camera.interactive = False
         b4.border_color = (0.5, 0.5, 0.5, 1)
-        self.desc_add = Text('ADD ACTION: add action_name [-focus]', color='white', rotation=0,
+        self.desc_add = Text('ADD ACTION: add action_name [-focus] [-last]', color='white', rotation=0,
                              anchor_x="left",
                              anchor_y="bottom",
                              font_size=10, pos=(0.1, 0.9))
@@ -138,6 +146,10 @@ class VISPYVisualizer:
         self.desc_remove = Text('REMOVE ACTION: remove action_name', color='white', rotation=0, anchor_x="left",
                                 anchor_y="bottom",
                                 font_size=10, pos=(0.1, 0.5))
+        self.desc_profile = Text('PROFILE: profile n_frames [main] [hpe] [focus]', color='white', rotation=0,
+                                 anchor_x="left",
+                                 anchor_y="bottom",
+                                 font_size=10, pos=(0.1, 0.4))
         self.input_string = Text(self.input_text, color='purple', rotation=0, anchor_x="left", anchor_y="bottom",
                                  font_size=12, pos=(0.1, 0.3))
         self.log = Text('', color='orange', rotation=0, anchor_x="left", anchor_y="bottom",
@@ -147,6 +159,7 @@ class VISPYVisualizer:
         b4.add(self.desc_load)
         b4.add(self.desc_debug)
         b4.add(self.desc_remove)
+        b4.add(self.desc_profile)
         b4.add(self.input_string)
         b4.add(self.log)
 
@@ -157,15 +170,19 @@ class VISPYVisualizer:
         elements = self.input_queue.get()
         if not elements:
             return
+        start = time.time()
         # Parse elements
         elements = elements
-        if "ACK" in elements.keys():  # Just an ack flag
-            return
         if "log" in elements.keys():
             self.log.text = elements["log"]
 
         fps = elements["fps"]
-        img = elements["img"]
+        if "preview" in elements.keys():  # Otherwise the last one is shown again
+            img = elements["preview"]
+            if img.ndim == 1:  # JPEG
+                img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+            h, w = elements["img_shape"][:2]
+            self.last_img = cv2.resize(img, (w, h)) if img.shape[:2] != (h, w) else img
 
         bbox = elements["bbox"] if "bbox" in elements.keys() else None
         edges = elements["edges"] if "edges" in elements.keys() else None
@@ -195,16 +212,17 @@ class VISPYVisualizer:
                 self.lines[i].set_data(color="grey",
                                        edge_color="white")
 
-        # IMAGE
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        if bbox is not None:
-            x1, x2, y1, y2 = bbox
-            img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 3)
-        if face_bbox is not None:
-            x1, y1, x2, y2 = face_bbox
-            color = (255, 0, 0) if not focus else (0, 255, 0)
-            img = cv2.rectangle(img, (x1, y1), (x2, y2), color, 3)
-        self.image.set_data(cv2.flip(img, 0))
+        # IMAGE (not until a preview arrives, e.g. with preview_every None)
+        if self.last_img is not None:
+            img = cv2.cvtColor(self.last_img, cv2.COLOR_BGR2RGB)
+            if bbox is not None:
+                x1, x2, y1, y2 = bbox
+                img = cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 3)
+            if face_bbox is not None:
+                x1, y1, x2, y2 = face_bbox
+                color = (255, 0, 0) if not focus else (0, 255, 0)
+                img = cv2.rectangle(img, (x1, y1), (x2, y2), color, 3)
+            self.image.set_data(cv2.flip(img, 0))
 
         # INFO
         if focus:
@@ -214,6 +232,11 @@ class VISPYVisualizer:
             self.focus.text = "NOT FOC."
             self.focus.color = "red"
         self.fps.text = "FPS: {:.2f}".format(fps)
+        if "ingestion" in elements.keys():
+            ingestion = elements["ingestion"]
+            self.ingestion.text = "DROP: {} / {}  STALE: {:.0f}ms".format(ingestion["dropped"],
+                                                                        ingestion["dropped"] + ingestion["processed"],
+                                                                        ingestion["staleness"] * 1000)
         self.distance.text = "DIST: {:.2f}m".format(distance) if distance is not None else "DIST:"
         # Actions
         m = max(results.values()) if len(results) > 0 else 0  # Just max
@@ -276,5 +299,12 @@ class VISPYVisualizer:
         if len(self.actions) == 0:
             self.os_score.center = (2, 2)
 
+        # Glass to glass: from the capture to the update of the canvas (drawn at the next refresh)
+        end = time.time()
+        tracer.record("vispy.update", start, end, elements.get("id"))
+        if "ts" in elements.keys():
+            tracer.record("glass_to_glass", elements["ts"], end, elements.get("id"))
+        tracer.maybe_export()
+
     def on_draw(self, event):
         pass
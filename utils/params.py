@@ -20,21 +20,57 @@ class MainConfig(object):
         self.window_size = seq_len
         self.skeleton_scale = 2200.
         self.acquisition_time = 3  # Seconds
+        self.enrollment_delay = 3  # Seconds between the add command and the start of the acquisition
+        self.pipeline_depth = 2  # Frames in flight at the same time, 1 disables pipelining
+        self.shared_frames = True  # Send frames to HPE and focus through shared memory instead of pickling them
+        self.frame_write_timeout = 10.  # Seconds waiting for a free slot of the shared frames, then it raises
+        self.execution = {"hpe": "process", "focus": "process"}  # process, or thread in main.py (no copy of frames)
+        self.hpe_workers = 1  # HPE workers taking frames round-robin, at most pipeline_depth (times the streams)
+        self.os_thresh = 0.66  # Open-set score over which an action is triggered
+        self.focus_every = 1  # Focus runs at most once every this many frames
+        self.focus_os_margin = 0.3  # Focus runs only if the open-set score is over os_thresh - margin (None: always)
+        self.max_frame_age = 0.1  # Seconds after capture, older frames are dropped (None never drops)
+        self.hpe_deadline = 0.5  # Seconds after submission, then the last pose is shown (None waits forever)
+        self.focus_deadline = 0.5  # Seconds after submission, then the last focus is shown (None waits forever)
+        self.max_misses = 5  # Deadlines missed in a row after which a worker is restarted
+        self.target_fps = None  # Quality (focus rate, AR stride, people in multi-person) adapts to it, None disables
+        self.adapt_every = 30  # Frames between two quality decisions
+        self.transport = "socket"  # Between source.py and main.py: manager (manager.py), socket or shm (same host)
+        self.transport_socket = os.path.join("assets", "transport.sock")  # Unix socket for socket and shm
+        self.transport_port = None  # If set, socket and shm use TCP on this port (e.g. docker without Unix sockets)
+        self.metrics_path = os.path.join("assets", "metrics")  # Stage latencies of every process, None disables
+        self.metrics_format = "json"  # json or prom (Prometheus text)
+        self.metrics_every = 5  # Seconds between two exports
+        self.trace_path = None  # Per-frame spans of every process (e.g. os.path.join("assets", "traces")), None disables
+        self.trace_every = 5  # Seconds between two exports, merge them with python -m utils.tracing
+        self.track_iou = 0.3  # Multi-person: minimum IoU between the boxes of a track in consecutive frames
+        self.track_max_age = 10  # Multi-person: frames a track survives without being seen
+        self.preview_every = 1  # Frames between two previews of the frame sent to the visualizer, None never sends it
+        self.preview_scale = 0.5  # Size of the preview w.r.t. the frame
+        self.preview_quality = 80  # JPEG quality of the preview, None sends it as raw pixels
+        self.streams = ["cam0", "cam1"]  # Cameras served by server.py, each source.py runs with --stream NAME
 
 
 class MetrabsTRTConfig(object):
     def __init__(self):
+        self.batch_size = 1  # BATCH_SIZE of the engines (modules/hpe/setup), crops of different humans share a call
         self.yolo_engine_path = os.path.join('modules', 'hpe', 'weights', engine_dir, 'yolo.engine')
-        self.image_transformation_path = os.path.join('modules', 'hpe', 'weights', engine_dir, 'image_transformation1.engine')
-        self.bbone_engine_path = os.path.join('modules', 'hpe', 'weights', engine_dir, 'bbone1.engine')
-        self.heads_engine_path = os.path.join('modules', 'hpe', 'weights', engine_dir, 'heads1.engine')
+        self.image_transformation_path = os.path.join('modules', 'hpe', 'weights', engine_dir, f'image_transformation{self.batch_size}.engine')
+        self.bbone_engine_path = os.path.join('modules', 'hpe', 'weights', engine_dir, f'bbone{self.batch_size}.engine')
+        self.heads_engine_path = os.path.join('modules', 'hpe', 'weights', engine_dir, f'heads{self.batch_size}.engine')
         self.expand_joints_path = 'assets/32_to_122.npy'
         self.skeleton_types_path = 'assets/skeleton_types.pkl'
         self.skeleton = skeleton_type
         self.yolo_thresh = 0.3
         self.nms_thresh = 0.7
-        self.num_aug = 0  # if zero, disables test time augmentation
+        self.num_aug = 0  # if zero, disables test time augmentation (otherwise, it must be equal to batch_size)
+        self.detect_every = 1  # Yolo runs at least once every this many frames, in between the boxes follow the poses
+        self.track_min_fov = 0.5  # Fraction of the joints inside the crop under which yolo runs on the next frame
+        self.track_max_drop = 0.2  # Drop of that fraction since the detection after which yolo runs on the next frame
+        self.track_margin = 0.1  # Fraction of the size of a 2D pose added on each side of its box when tracking
         self.just_box = input_type == "rgb"
+        self.multi_person = False  # Estimate every human (up to max_people) instead of the most confident one
+        self.max_people = 5
 
 
 class RealSenseIntrinsics(object):
@@ -92,6 +128,7 @@ class TRXConfig(object):
         elif input_type == "hybrid":
             self.final_ckpt_path = "modules/ar/modules/raws/hybrid/1714_truncated_resnet.pth"
         self.trt_path = 'modules/ar/modules/{}/trx.engine'.format(engine_dir)
+        self.load_cache = True  # Load-time cache only: read the raw copy of the checkpoint (utils/weight_store.py)
         self.seq_len = seq_len
 
 
@@ -0,0 +1,50 @@
+import cProfile
+import os
+import pstats
+
+
+class FrameProfiler:
+    """
+    cProfile of the next n frames of a running process (see the profile command of ISBFSAR).
+    The request can come from another thread, it starts with the next frame
+    """
+    def __init__(self, name):
+        self.name = name
+        self.pending = None  # (n, path) requested and not started yet
+        self.profile = None
+        self.left = 0
+        self.path = None
+
+    def request(self, n, path):
+        self.pending = (n, path)
+
+    def begin(self):
+        """
+        Call before the work on a frame
+        """
+        if self.profile is None and self.pending is not None:
+            (self.left, self.path), self.pending = self.pending, None
+            self.profile = cProfile.Profile()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def end(self):
+        """
+        Call after the work on a frame, it returns the path of the report when the last frame is done
+        """
+        if self.profile is None:
+            return None
+        self.profile.disable()
+        self.left -= 1
+        if self.left > 0:
+            return None
+        return self.dump()
+
+    def dump(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.profile.dump_stats(os.path.join(self.path, f"{self.name}.prof"))  # For snakeviz and co.
+        report = os.path.join(self.path, f"{self.name}.txt")
+        with open(report, "w") as outfile:
+            pstats.Stats(self.profile, stream=outfile).sort_stats("cumulative").print_stats(50)
+        self.profile = None
+        return report
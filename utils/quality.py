@@ -0,0 +1,59 @@
+from collections import deque
+
+
+class QualityController:
+    """
+    Trade quality for speed to hold target_fps: every adapt_every frames the fps the pipeline could reach (from the
+    time it is busy on each frame, without waiting for the camera) is compared with the target, and the quality goes
+    one level down if it is too low, or one level up if there is enough headroom.
+    Level 0 is the configuration, every next level relaxes one knob a little more:
+    - focus_every: focus runs on fewer frames
+    - ar_stride: action recognition scores one frame every ar_stride (the windows still get every frame)
+    - max_people: in multi-person mode, fewer humans go through the pose estimation
+    """
+    def __init__(self, args, multi_person=False, max_people=1):
+        self.target = args.target_fps
+        self.every = args.adapt_every
+        self.busy = deque(maxlen=args.adapt_every)
+        self.levels = [{"focus_every": args.focus_every, "ar_stride": 1, "max_people": max_people}]
+        while True:
+            level = dict(self.levels[-1])
+            if level["focus_every"] < 8:
+                level["focus_every"] = max(level["focus_every"] * 2, 2)
+            elif level["ar_stride"] < 4:
+                level["ar_stride"] += 1
+            elif multi_person and level["max_people"] > 1:
+                level["max_people"] -= 1
+            else:
+                break
+            self.levels.append(level)
+        self.level = 0
+        self.frames = 0
+
+    @property
+    def knobs(self):
+        return self.levels[self.level]
+
+    def update(self, busy):
+        """
+        It receives the time between the last two results minus the time spent waiting for a frame,
+        it returns a message if the quality changed
+        """
+        if self.target is None:
+            return None
+        self.busy.append(busy)
+        self.frames += 1
+        if self.frames < self.every:
+            return None
+        self.frames = 0
+        fps = len(self.busy) / max(sum(self.busy), 1e-6)
+        if fps < 0.95 * self.target and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif fps > 1.3 * self.target and self.level > 0:
+            self.level -= 1
+        else:
+            return None
+        self.busy.clear()  # The next decision sees only the new level
+        return "Quality {}/{} at {:.1f} fps: {}".format(
+            len(self.levels) - 1 - self.level, len(self.levels) - 1, fps,
+            ", ".join(f"{k}={v}" for k, v in self.knobs.items()))
@@ -0,0 +1,85 @@
+from multiprocessing import Condition, RawArray
+from multiprocessing.shared_memory import SharedMemory
+import time
+import numpy as np
+
+
+class SharedFrameRing:
+    """
+    Fixed pool of frame slots in shared memory, used to send the same frame to many worker processes.
+    The writer copies each frame once into a free slot and sends only the reference (slot, frame_id) through the
+    queues, the readers map the slot in place. The reference is released once for each reader when it is done, by
+    the writer when it gets the result of the reader: a reader killed while reading can not release it twice.
+    A slot is reused only after all its readers released it, so a slow reader can not see its frame overwritten.
+    """
+    def __init__(self, n_slots, shape, dtype=np.uint8):
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = SharedMemory(create=True, size=self.slot_size * n_slots)
+        self.readers = RawArray('i', n_slots)  # Readers that still have to release each slot
+        self.frame_ids = RawArray('q', n_slots)  # Frame currently stored in each slot
+        self.released = Condition()  # Protects readers and frame_ids, notified on each release
+        self.next_slot = 0
+        self.next_frame_id = 0
+        self.owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['owner'] = False  # Only the process that created the ring unlinks it
+        return state
+
+    def _view(self, slot):
+        return np.ndarray(self.shape, self.dtype, buffer=self.shm.buf, offset=slot * self.slot_size)
+
+    def _free_slot(self):
+        for i in range(self.n_slots):
+            slot = (self.next_slot + i) % self.n_slots
+            if self.readers[slot] == 0:
+                self.next_slot = (slot + 1) % self.n_slots
+                return slot
+        return None
+
+    def write(self, frame, n_readers, timeout=None):
+        """
+        Copy the frame into a free slot (waiting up to timeout seconds for a release if all of them are in use)
+        and return the reference that the n_readers must receive
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.released:
+            slot = self._free_slot()
+            while slot is None:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError(f"No free slot in {timeout} s, the {self.n_slots} slots were not released")
+                self.released.wait(remaining)
+                slot = self._free_slot()
+            frame_id = self.next_frame_id
+            self.next_frame_id += 1
+            self.readers[slot] = n_readers
+            self.frame_ids[slot] = frame_id
+        np.copyto(self._view(slot), frame)  # Nobody knows the reference yet, no need to hold the lock
+        return slot, frame_id
+
+    def read(self, ref):
+        """
+        Return a read-only view of the frame, valid until the reference is released
+        """
+        slot, frame_id = ref
+        if self.frame_ids[slot] != frame_id:
+            raise RuntimeError(f"Frame {frame_id} is not in slot {slot} anymore")
+        view = self._view(slot)
+        view.flags.writeable = False
+        return view
+
+    def release(self, ref):
+        slot, _ = ref
+        with self.released:
+            self.readers[slot] -= 1
+            self.released.notify_all()
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -6,9 +6,10 @@ from loguru import logger
 
 
 class HostDeviceMem(object):
-    def __init__(self, host_mem, device_mem):
+    def __init__(self, host_mem, device_mem, shape=None):
         self.host = host_mem
         self.device = device_mem
+        self.shape = shape
 
     def __str__(self):
         return "Host:\n" + str(self.host) + "\nDevice:\n" + str(self.device)
@@ -40,7 +41,7 @@ class Runner:
             device_mem = cuda.mem_alloc(host_mem.nbytes)  # (256 x 256 x 3 ) x (32 / 4)
             bindings.append(int(device_mem))
             if engine.binding_is_input(binding):
-                inputs.append(HostDeviceMem(host_mem, device_mem))
+                inputs.append(HostDeviceMem(host_mem, device_mem, tuple(engine.get_binding_shape(binding))))
             else:
                 outputs.append(HostDeviceMem(host_mem, device_mem))
 
@@ -61,6 +62,14 @@ class Runner:
         args = [np.random.rand(*inp.host.shape).astype(inp.host.dtype) for inp in self.inputs]
         self(*args)
 
+    def input_buffer(self, i=0):
+        """
+        Pinned host memory of the i-th input with the shape of its binding: the caller can write the input there and
+        call the runner without that argument, to skip a copy
+        """
+        inp = self.inputs[i]
+        return inp.host.reshape(inp.shape)
+
     def __call__(self, *args):
 
         for i, x in enumerate(args):
@@ -0,0 +1,97 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+"""
+Per-frame spans of every process (source, main, workers, VISPY), in a ring buffer of the process that is
+periodically written to trace_path/<process>.json. Spans are on the wall clock, so the files of the processes
+of the same host can be merged into a single Chrome trace (chrome://tracing or https://ui.perfetto.dev) with:
+python -m utils.tracing [trace_path]
+"""
+
+
+class Tracer:
+    def __init__(self, size=10000):
+        self.events = deque(maxlen=size)  # (name, frame, start, end, thread id)
+        self.name = None
+        self.path = None
+        self.every = None
+        self.last_export = time.time()
+        self.lock = threading.RLock()  # Worker threads of main.py export too (see execution in MainConfig)
+        self.frame = None  # Frame the process is working on, given to the spans that do not specify one
+        self.offset = time.time() - time.perf_counter()  # From perf_counter (of the stopwatches) to wall clock
+
+    def configure(self, name, args):
+        self.name = name
+        self.every = args.trace_every
+        if args.trace_path is not None:
+            os.makedirs(args.trace_path, exist_ok=True)
+            self.path = os.path.join(args.trace_path, f"{name}.json")
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def record(self, name, start, end, frame=None):
+        """
+        Span of the given frame between two wall clock times
+        """
+        if self.enabled:
+            self.events.append((name, self.frame if frame is None else frame, start, end, threading.get_ident()))
+
+    def record_perf(self, name, start, end, frame=None):
+        """
+        Span of the given frame between two perf_counter times
+        """
+        self.record(name, start + self.offset, end + self.offset, frame)
+
+    def to_chrome(self):
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        for name, frame, start, end, tid in list(self.events):
+            events.append({"name": name, "cat": name.split(".")[0], "ph": "X", "pid": pid, "tid": tid,
+                           "ts": start * 1e6, "dur": (end - start) * 1e6, "args": {"frame": frame}})
+        return events
+
+    def export(self, path=None):
+        path = self.path if path is None else path
+        with self.lock:
+            with open(path + ".tmp", "w") as outfile:  # Readers never see a half written file
+                json.dump({"traceEvents": self.to_chrome()}, outfile)
+            os.replace(path + ".tmp", path)
+        return path
+
+    def maybe_export(self):
+        with self.lock:
+            if self.enabled and time.time() - self.last_export > self.every:
+                self.export()
+                self.last_export = time.time()
+
+
+def merge(trace_path, output=None):
+    """
+    Merge the traces of all the processes in a single Chrome trace
+    """
+    output = os.path.join(trace_path, "trace.json") if output is None else output
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_path, "*.json"))):
+        if os.path.abspath(path) == os.path.abspath(output):
+            continue
+        with open(path) as infile:
+            events += json.load(infile)["traceEvents"]
+    with open(output, "w") as outfile:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outfile)
+    return output
+
+
+tracer = Tracer()  # Ring buffer of the current process
+
+
+if __name__ == "__main__":
+    import sys
+    from utils.params import MainConfig
+    print(merge(sys.argv[1] if len(sys.argv) > 1 else MainConfig().trace_path))
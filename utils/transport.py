@@ -0,0 +1,324 @@
+import os
+import pickle
+import queue
+import select
+import socket
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.managers import BaseManager
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+
+"""
+Transports for the queues between the host (source.py) and main.py, that may run inside docker.
+Every transport gives queues with the put/get interface of queue.Queue (block, timeout, queue.Empty, queue.Full):
+- manager: BaseManager proxy queues served by manager.py, every message is pickled through the server process
+- socket: length-prefixed messages over a Unix domain socket (or TCP, e.g. towards host.docker.internal),
+  numpy arrays are sent as raw bytes right after a small pickled header
+- shm: like socket, but numpy arrays are written in shared memory by the writer and mapped by the reader,
+  only the header goes through the socket (same host only)
+With socket and shm the host side listens on a single address and main.py connects one socket for each queue.
+"""
+
+docker = os.environ.get('AM_I_IN_A_DOCKER_CONTAINER', False)
+PREFIX = struct.Struct('!II')  # Header length, payload length
+READ = b'R'  # Sent back by the reader when it gets a message
+FREE = b'F'  # Sent back by the reader of shm, followed by the index of the segment it does not use anymore
+MAX_SEGMENTS = 256  # Segments of a shm writer, their index is sent back in a byte
+
+
+def split_arrays(msg):
+    """
+    Separate the numpy arrays of a message (first level only) from the rest, that is small and can be pickled
+    """
+    rest, arrays = {}, []
+    for k, v in msg.items():
+        if isinstance(v, np.ndarray) and v.dtype != object:
+            arrays.append((k, np.ascontiguousarray(v)))
+        else:
+            rest[k] = v
+    return rest, arrays
+
+
+class SocketQueue:
+    """
+    One-way queue over a connected socket.
+    The reader answers READ to every message, so the writer never has more than maxsize messages not yet read.
+    The arrays returned by get are fresh buffers, so manual and release are there just for compatibility with
+    SharedMemoryQueue
+    """
+    def __init__(self, sock, maxsize=1, manual=False):
+        self.sock = sock
+        self.maxsize = maxsize
+        self.sent = 0
+        self.read = 0
+
+    # WRITER ##########################################################################################################
+    def _on_ack(self, ack):
+        if ack == READ[0]:
+            self.read += 1
+
+    def _poll_acks(self, timeout):
+        r, _, _ = select.select([self.sock], [], [], timeout)
+        if r:
+            acks = self.sock.recv(4096)
+            if not acks:
+                raise ConnectionError("Queue reader disconnected")
+            for ack in acks:
+                self._on_ack(ack)
+
+    def _wait_room(self, block, timeout):
+        self._poll_acks(0)
+        deadline = None if timeout is None else time.time() + timeout
+        while self.sent - self.read >= self.maxsize:
+            remaining = None if deadline is None else deadline - time.time()
+            if not block or (remaining is not None and remaining <= 0):
+                raise queue.Full
+            self._poll_acks(remaining)
+
+    def _pack(self, rest, arrays):
+        descriptors = [(k, a.dtype.str, a.shape) for k, a in arrays]
+        header = pickle.dumps((rest, descriptors), protocol=pickle.HIGHEST_PROTOCOL)
+        return header, [a.data.cast('B') for _, a in arrays]
+
+    def put(self, msg, block=True, timeout=None):
+        self._wait_room(block, timeout)
+        header, buffers = self._pack(*split_arrays(msg))
+        self.sock.sendall(PREFIX.pack(len(header), sum(b.nbytes for b in buffers)) + header)
+        for b in buffers:
+            self.sock.sendall(b)
+        self.sent += 1
+
+    def put_nowait(self, msg):
+        self.put(msg, block=False)
+
+    # READER ##########################################################################################################
+    def _recv_exactly(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n > 0:
+            received = self.sock.recv_into(view[len(buf) - n:], n)
+            if received == 0:
+                raise ConnectionError("Queue writer disconnected")
+            n -= received
+        return buf
+
+    def _unpack(self, header, payload):
+        rest, descriptors = pickle.loads(header)
+        offset = 0
+        for k, dtype, shape in descriptors:
+            a = np.frombuffer(payload, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            rest[k] = a
+            offset += a.nbytes
+        return rest
+
+    def _ack(self, ack):
+        try:
+            self.sock.sendall(ack)
+        except (BrokenPipeError, ConnectionResetError):  # Writer already closed, what was got is still good
+            pass
+
+    def get(self, block=True, timeout=None):
+        r, _, _ = select.select([self.sock], [], [], timeout if block else 0)
+        if not r:
+            raise queue.Empty
+        header_len, payload_len = PREFIX.unpack(self._recv_exactly(PREFIX.size))
+        header = self._recv_exactly(header_len)
+        payload = self._recv_exactly(payload_len)
+        self._ack(READ)
+        return self._unpack(header, payload)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def release(self, msg):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+
+class SharedMemoryQueue(SocketQueue):
+    """
+    SocketQueue whose arrays are written by the writer in shared memory segments and mapped by the reader.
+    The arrays returned by get stay valid until the reader sends FREE for their segment, then the writer can reuse it:
+    at the next call to get, or, if manual, when the message is given to release (every message got must be)
+    """
+    def __init__(self, sock, maxsize=1, manual=False):
+        super().__init__(sock, maxsize)
+        self.manual = manual
+        self.segments = {}  # Writer: own segments, reader: attached segments (by name)
+        self.own = set()  # Names of the segments created (and to be unlinked) by this side
+        self.free = []  # Writer: segments that can be reused
+        self.names = []  # Writer: names of the own segments, by index
+        self.freeing = False  # Writer: the next ack is the index of a freed segment
+        self.held = {}  # Reader: index of the segment of each message got and not freed (by id of the message)
+
+    def _on_ack(self, ack):
+        if self.freeing:
+            self.free.append(self.names[ack])
+            self.freeing = False
+        elif ack == FREE[0]:
+            self.freeing = True
+        else:
+            super()._on_ack(ack)
+
+    def _segment(self, size):
+        for name in self.free:
+            if self.segments[name].size >= size:
+                self.free.remove(name)
+                return self.segments[name]
+        if len(self.names) == MAX_SEGMENTS:
+            raise RuntimeError(f"More than {MAX_SEGMENTS} shared memory segments in use, the reader does not free them")
+        shm = SharedMemory(create=True, size=max(size, 1))
+        self.segments[shm.name] = shm
+        self.own.add(shm.name)
+        self.names.append(shm.name)
+        return shm
+
+    def _pack(self, rest, arrays):
+        if len(arrays) == 0:  # Nothing to map, e.g. commands
+            return pickle.dumps((rest, None, None, []), protocol=pickle.HIGHEST_PROTOCOL), []
+        shm = self._segment(sum(a.nbytes for _, a in arrays))
+        descriptors = []
+        offset = 0
+        for k, a in arrays:
+            np.copyto(np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset), a)
+            descriptors.append((k, a.dtype.str, a.shape, offset))
+            offset += a.nbytes
+        index = self.names.index(shm.name)
+        header = pickle.dumps((rest, shm.name, index, descriptors), protocol=pickle.HIGHEST_PROTOCOL)
+        return header, []
+
+    def _unpack(self, header, payload):
+        rest, name, index, descriptors = pickle.loads(header)
+        if name is None:
+            return rest
+        if name not in self.segments:
+            self.segments[name] = SharedMemory(name=name)
+            try:  # The writer owns the segment, the tracker of the reader must not unlink it at exit
+                resource_tracker.unregister(self.segments[name]._name, 'shared_memory')
+            except Exception:
+                pass
+        shm = self.segments[name]
+        for k, dtype, shape, offset in descriptors:
+            rest[k] = np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+        self.held[id(rest)] = index
+        return rest
+
+    def release(self, msg):
+        """
+        The arrays of msg are not used anymore, the writer can overwrite them
+        """
+        index = self.held.pop(id(msg), None)
+        if index is not None:
+            self._ack(FREE + bytes([index]))
+
+    def get(self, block=True, timeout=None):
+        if not self.manual:
+            for index in self.held.values():
+                self._ack(FREE + bytes([index]))
+            self.held.clear()
+        return super().get(block, timeout)
+
+    def close(self):
+        super().close()
+        for name, shm in self.segments.items():
+            shm.close()
+            if name in self.own:
+                shm.unlink()
+
+
+class ManagerTransport:
+    def __init__(self, address, authkey=b'abracadabra'):
+        BaseManager.register('get_queue')
+        self.manager = BaseManager(address=address, authkey=authkey)
+        self.manager.connect()
+
+    def get_queue(self, name, **kwargs):
+        return self.manager.get_queue(name)
+
+
+class SocketTransport:
+    """
+    The listening side accepts one connection for each queue, the connecting side sends the name of the queue
+    as first message
+    """
+    queue_class = SocketQueue
+
+    def __init__(self, address, listen=False):
+        self.address = address
+        self.family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self.pending = {}  # Accepted connections waiting for their get_queue
+        self.server = None
+        if listen:
+            if self.family == socket.AF_UNIX:
+                os.makedirs(os.path.dirname(address) or '.', exist_ok=True)
+                if os.path.exists(address):
+                    os.remove(address)
+            self.server = socket.socket(self.family, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(('', address[1]) if self.family == socket.AF_INET else address)
+            self.server.listen()
+
+    def _configure(self, sock):
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _accept(self, name):
+        while name not in self.pending:
+            sock, _ = self.server.accept()
+            n = sock.recv(1)[0]
+            self.pending[sock.recv(n, socket.MSG_WAITALL).decode()] = sock
+        return self._configure(self.pending.pop(name))
+
+    def _connect(self, name):
+        while True:  # Wait for the other side to listen
+            try:
+                sock = socket.socket(self.family, socket.SOCK_STREAM)
+                sock.connect(self.address)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                sock.close()
+                time.sleep(0.5)
+        sock.sendall(bytes([len(name)]) + name.encode())
+        return self._configure(sock)
+
+    def get_queue(self, name, maxsize=1, **kwargs):
+        sock = self._accept(name) if self.server is not None else self._connect(name)
+        return self.queue_class(sock, maxsize, **kwargs)
+
+
+class SharedMemoryTransport(SocketTransport):
+    queue_class = SharedMemoryQueue
+
+
+def queue_name(name, stream=None):
+    """
+    Name of a queue of the given stream (camera), when main.py serves more than one (see server.py)
+    """
+    return name if stream is None else f"{name}_{stream}"
+
+
+def get_transport(args, listen=False, stream=None):
+    """
+    Create the transport selected in MainConfig, listen must be True on the host side (source.py).
+    Each stream of MainConfig.streams listens on its own address: the socket path gets the name of the stream,
+    the TCP port is incremented by its index
+    """
+    host = "host.docker.internal" if docker else "localhost"
+    if args.transport == "manager":
+        return ManagerTransport((host, 50000))
+    if args.transport_port is not None:
+        address = (host, args.transport_port + (args.streams.index(stream) if stream is not None else 0))
+    else:
+        root, ext = os.path.splitext(args.transport_socket)
+        address = args.transport_socket if stream is None else f"{root}_{stream}{ext}"
+    if args.transport == "socket":
+        return SocketTransport(address, listen)
+    if args.transport == "shm":
+        return SharedMemoryTransport(address, listen)
+    raise ValueError(f"Unknown transport {args.transport}")
@@ -0,0 +1,99 @@
+import queue
+import time
+
+
+class Watchdog:
+    """
+    Results of a worker, tagged with the submission number of their frame.
+    The result of a frame is waited until its deadline: the results that arrive later are discarded, and a worker
+    that misses max_misses deadlines in a row is stalled (it has to be restarted). After a restart, misses are not
+    counted until the new worker says it is ready or gives its first result (it is loading its models).
+    The shared frame reference of a frame is given to release when its result arrives, or when the worker is drained
+    """
+    def __init__(self, name, max_misses, release=None):
+        self.name = name
+        self.max_misses = max_misses
+        self.release = release
+        self.output = None  # Output queue of the current worker
+        self.pending = {}  # Tag: shared frame reference given to the worker, released when its result arrives
+        self.skipped = set()  # Tags not submitted because the input queue was full
+        self.early = {}  # Results got while waiting for an older frame
+        self.misses = 0
+        self.discarded = 0
+        self.loading = False
+
+    def submitted(self, tag, ref=None):
+        if ref is not None:
+            self.pending[tag] = ref
+
+    def _received(self, tag, result):
+        ref = self.pending.pop(tag, None)
+        if ref is not None:
+            self.release(ref)
+        self.loading = False
+        return result
+
+    def _missed(self):
+        if not self.loading:
+            self.misses += 1
+        return False, None
+
+    def get(self, tag, deadline=None):
+        """
+        It returns (True, result) or (False, None) if the result of the frame did not arrive before the deadline
+        (time.time() based, None waits forever)
+        """
+        if tag in self.skipped:
+            self.skipped.remove(tag)
+            return self._missed()
+        for old in [t for t in self.early.keys() if t < tag]:  # Frames already served stale
+            self.early.pop(old)
+            self.discarded += 1
+        if tag in self.early.keys():
+            self.misses = 0
+            return True, self.early.pop(tag)
+        while True:
+            remaining = None if deadline is None else deadline - time.time()
+            try:
+                got, result = self.output.get(block=remaining is None or remaining > 0, timeout=remaining)
+            except queue.Empty:
+                return self._missed()
+            if got == "ready":
+                self.loading = False
+                continue
+            result = self._received(got, result)
+            if got == tag:
+                self.misses = 0
+                return True, result
+            if got > tag:  # The result of this frame was lost (e.g. the worker was restarted)
+                self.early[got] = result
+                return self._missed()
+            self.discarded += 1  # Late result of a frame that was already served stale
+
+    def drain(self, output):
+        """
+        Collect what the stopped worker already sent and release the references of all its frames
+        """
+        while True:
+            try:
+                got, result = output.get(block=False)
+            except (queue.Empty, OSError, EOFError):
+                break
+            if got == "ready":
+                continue
+            self.early[got] = result
+        for ref in self.pending.values():
+            self.release(ref)
+        self.pending = {}
+
+    @property
+    def stalled(self):
+        return self.misses >= self.max_misses
+
+    def attach(self, output):
+        """
+        Start waiting the results of a new worker
+        """
+        self.output = output
+        self.misses = 0
+        self.loading = True
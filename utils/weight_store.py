@@ -0,0 +1,83 @@
+import json
+import os
+import warnings
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+"""
+Checkpoints converted once into a flat file of raw tensors (<checkpoint>.weights, with its index in
+<checkpoint>.weights.json) that is mapped read-only instead of unpickled, which makes cold loads faster.
+load_state_dict still copies the weights into the parameters of the model (then moved to the GPU), so the memory
+of a running process is the same as with torch.load. The store is rebuilt when the checkpoint changes, to convert
+ahead of time: python -m utils.weight_store CHECKPOINT [KEY]
+"""
+
+
+ALIGNMENT = 64  # Bytes, each tensor starts aligned
+
+
+def store_paths(ckpt_path):
+    return ckpt_path + ".weights", ckpt_path + ".weights.json"
+
+
+def is_fresh(ckpt_path, key=None):
+    _, index_path = store_paths(ckpt_path)
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as infile:
+        index = json.load(infile)
+    return index["mtime"] == os.path.getmtime(ckpt_path) and index["key"] == key
+
+
+def convert(ckpt_path, key=None):
+    """
+    Write the state dict of the checkpoint (checkpoint[key] if key is given) in the store
+    """
+    state_dict = torch.load(ckpt_path, map_location="cpu")
+    if key is not None:
+        state_dict = state_dict[key]
+    data_path, index_path = store_paths(ckpt_path)
+    tmp = f".{os.getpid()}.tmp"  # Processes converting at the same time do not mix their files
+    tensors = {}
+    offset = 0
+    with open(data_path + tmp, "wb") as outfile:
+        for name, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            tensors[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            outfile.write(array.tobytes())
+            offset += array.nbytes
+            padding = -offset % ALIGNMENT
+            outfile.write(bytes(padding))
+            offset += padding
+    with open(index_path + tmp, "w") as outfile:
+        json.dump({"mtime": os.path.getmtime(ckpt_path), "key": key, "tensors": tensors}, outfile)
+    os.replace(data_path + tmp, data_path)
+    os.replace(index_path + tmp, index_path)  # Last, the store is valid only with its index
+    return data_path
+
+
+def load(ckpt_path, key=None):
+    """
+    State dict of the checkpoint (checkpoint[key] if key is given) as read-only CPU tensors mapped from the store,
+    converted first if needed. load_state_dict copies them into the model
+    """
+    if not is_fresh(ckpt_path, key):
+        convert(ckpt_path, key)
+    data_path, index_path = store_paths(ckpt_path)
+    with open(index_path) as infile:
+        tensors = json.load(infile)["tensors"]
+    data = np.memmap(data_path, mode="r") if os.path.getsize(data_path) > 0 else np.empty(0, np.uint8)
+    state_dict = OrderedDict()
+    with warnings.catch_warnings():  # Tensors of read-only arrays are fine, nobody writes them
+        warnings.simplefilter("ignore", UserWarning)
+        for name, t in tensors.items():
+            array = np.ndarray(t["shape"], np.dtype(t["dtype"]), buffer=data, offset=t["offset"])
+            state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+
+if __name__ == "__main__":
+    import sys
+    print(convert(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))